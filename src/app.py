@@ -1,5 +1,5 @@
 from fastapi import FastAPI
-from routers import images, transform, filters, data, users
+from routers import images, transform, filters, data, users, public
 
 app = FastAPI()
 
@@ -8,6 +8,7 @@ app.include_router(transform.router,  prefix="/api")
 app.include_router(filters.router,  prefix="/api")
 app.include_router(data.router, prefix="/api")
 app.include_router(users.router, prefix="/api")
+app.include_router(public.router, prefix="/api")
 
 @app.get("/")
 async def root():
@@ -2,6 +2,7 @@ from datetime import datetime, timedelta
 from jose import jwt, JWTError
 from dotenv import load_dotenv
 import os
+import time
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
@@ -20,4 +21,24 @@ async def decode_token(token: str):
     except JWTError:
         return None
 
-    
\ No newline at end of file
+# Capability expiries are rounded up to this many seconds, so links minted for
+# the same image and operation within a window share one URL and one proxy
+# cache entry.
+CAPABILITY_EXPIRY_BUCKET_SECONDS = 300
+CAPABILITY_MAX_EXPIRE_SECONDS = 7 * 24 * 3600
+
+async def create_capability_token(user_id: str, image_id: str, operation: str | None, params: dict, expires_in: int):
+    """
+    Sign a token granting read access to one image, or to one operation on it.
+    It carries no "sub", so it can never pass as a login token.
+    """
+    now = int(time.time())
+    expire = -(-(now + expires_in) // CAPABILITY_EXPIRY_BUCKET_SECONDS) * CAPABILITY_EXPIRY_BUCKET_SECONDS
+    to_encode = {"typ": "capability", "uid": user_id, "img": image_id, "op": operation, "params": dict(sorted(params.items())), "exp": expire}
+    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM), expire
+
+async def decode_capability_token(token: str):
+    payload = await decode_token(token)
+    if payload is None or payload.get("typ") != "capability":
+        return None
+    return payload
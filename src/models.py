@@ -8,6 +8,9 @@ class UserInDB(User):
     id: str = Field(alias='_id')
     username: str
     hashed_password: str
+    # Image-processing quota; None falls back to the server default.
+    max_in_flight: int | None = None
+    weight: float = 1.0
 
     class Config:
         populate_by_name = True
@@ -15,4 +18,9 @@ class UserInDB(User):
 
 class RegisterReq(BaseModel):
     username: str
-    password: str
\ No newline at end of file
+    password: str
+
+class LinkReq(BaseModel):
+    operation: str | None = None
+    params: dict = {}
+    expires_in: int = 3600
@@ -0,0 +1,314 @@
+from PIL import Image
+from io import BytesIO
+from bson.objectid import ObjectId
+from bson.binary import Binary
+from bson.errors import InvalidDocument
+from starlette.concurrency import run_in_threadpool
+from mongo.database_handler import db
+from fastapi import HTTPException
+from pymongo.errors import PyMongoError
+from models import UserInDB
+from processing.similarity import similarity_index, perceptual_hash, hash_memory
+from processing.scheduler import scheduler, estimate_cost, MIN_COST
+from processing.streaming import ChunkWriter
+import asyncio
+import json
+import os
+import tarfile
+import time
+import zipfile
+
+MAX_BULK_FILES = int(os.getenv("IMAGE_BULK_MAX_FILES", "1000"))
+# Images live in the user document, which MongoDB caps at 16 MB, so no
+# larger file could be stored.
+MAX_DOCUMENT_BYTES = 16 * 1024 * 1024
+MAX_FILE_BYTES = min(int(os.getenv("IMAGE_MAX_FILE_MB", "16")) * 1024 * 1024, MAX_DOCUMENT_BYTES)
+
+# Every write rewrites the user document. Files are stored in batches of
+# one $set each, capped in count and bytes.
+BATCH_FILES = 64
+BATCH_BYTES = 8 * 1024 * 1024
+
+MANIFEST_NAME = "manifest.json"
+archive_formats = {"tar": "application/x-tar", "zip": "application/zip"}
+
+def read_manifest(content: bytes) -> dict:
+    """Map archive paths to their manifest entries, ignoring a malformed manifest."""
+
+    try:
+        return {entry["path"]: entry for entry in json.loads(content)["images"]}
+    except Exception:
+        return {}
+
+def archive_entry(path: str, content: bytes, manifest: dict) -> dict:
+    entry = manifest.get(path, {})
+    return {
+        "filename": entry.get("filename") or os.path.basename(path),
+        "description": entry.get("description"),
+        "content": content
+    }
+
+def oversized(path: str) -> dict:
+    return {"filename": os.path.basename(path), "error": f"File exceeds {MAX_FILE_BYTES // (1024 * 1024)} MB"}
+
+def iter_zip(fp) -> iter:
+    with zipfile.ZipFile(fp) as archive:
+        names = set(archive.namelist())
+        manifest = read_manifest(archive.read(MANIFEST_NAME)) if MANIFEST_NAME in names else {}
+
+        for info in archive.infolist():
+            if info.is_dir() or info.filename == MANIFEST_NAME or info.filename.startswith("__MACOSX/"):
+                continue
+            if info.file_size > MAX_FILE_BYTES:
+                yield oversized(info.filename)
+                continue
+            with archive.open(info) as member:
+                yield archive_entry(info.filename, member.read(), manifest)
+
+def iter_tar(fp) -> iter:
+    manifest = {}
+    # Stream mode reads members in order without seeking; exports put the manifest first.
+    with tarfile.open(fileobj=fp, mode="r|*") as archive:
+        for info in archive:
+            if not info.isfile():
+                continue
+            if info.size > MAX_FILE_BYTES:
+                yield oversized(info.name)
+                continue
+            content = archive.extractfile(info).read()
+            if info.name == MANIFEST_NAME:
+                manifest = read_manifest(content)
+                continue
+            yield archive_entry(info.name, content, manifest)
+
+def iter_uploads(uploads: list) -> iter:
+    """Yield an entry per uploaded file, expanding zip and tar archives into their members."""
+
+    for upload in uploads:
+        fp = upload.file
+        is_zip = zipfile.is_zipfile(fp)
+        fp.seek(0)
+        is_tar = not is_zip and tarfile.is_tarfile(fp)
+        fp.seek(0)
+
+        try:
+            if is_zip:
+                yield from iter_zip(fp)
+            elif is_tar:
+                yield from iter_tar(fp)
+            elif upload.size is not None and upload.size > MAX_FILE_BYTES:
+                yield oversized(upload.filename)
+            else:
+                yield {"filename": upload.filename, "description": None, "content": fp.read()}
+        except (zipfile.BadZipFile, tarfile.TarError, EOFError) as e:
+            yield {"filename": upload.filename, "error": f"Unreadable archive: {str(e)}"}
+
+def read_batch(entries: iter, limit: int) -> list:
+    """Pull entries until a batch is full or `limit` entries have been read."""
+
+    batch = []
+    size = 0
+    while len(batch) < min(BATCH_FILES, limit) and size < BATCH_BYTES:
+        entry = next(entries, None)
+        if entry is None:
+            break
+        batch.append(entry)
+        size += len(entry.get("content") or b"")
+    return batch
+
+def validate_image(content: bytes) -> str:
+    """Check that the bytes are an image, without decoding its pixels, and return its content type."""
+
+    with Image.open(BytesIO(content)) as image:
+        format = image.format
+        image.verify()
+    return Image.MIME.get(format, f"image/{format.lower()}")
+
+def inspect_image(content: bytes) -> tuple:
+    return validate_image(content), perceptual_hash(content)
+
+async def check_image(user: UserInDB, content: bytes) -> tuple:
+    """
+    Validate and hash one file on the scheduler's workers, returning
+    (content type, perceptual hash). Bulk imports share the workers fairly
+    with other image work, and hashing reserves its decode memory. A file
+    that can't get the memory is stored without a hash.
+    """
+
+    try:
+        return await scheduler.run(user, estimate_cost(content), inspect_image, content, memory=hash_memory(content), capped=False)
+    except HTTPException:
+        return await scheduler.run(user, MIN_COST, validate_image, content, capped=False), None
+
+async def import_images(user: UserInDB, uploads: list, description: str = None) -> dict:
+    """
+    Validate and store uploaded files a batch at a time, so only one batch is
+    held in memory. Files in a batch are validated concurrently on the
+    scheduler's workers and stored with a single write. A write MongoDB
+    refuses ends the import there. Returns a result per file.
+    """
+
+    user_id = user.id
+    entries = iter_uploads(uploads)
+    results = []
+    truncated = False
+
+    while True:
+        batch = await run_in_threadpool(read_batch, entries, MAX_BULK_FILES - len(results))
+        if not batch:
+            truncated = len(results) >= MAX_BULK_FILES and await run_in_threadpool(next, entries, None) is not None
+            break
+
+        pending = [entry for entry in batch if "error" not in entry]
+        checks = await asyncio.gather(
+            *(check_image(user, entry["content"]) for entry in pending),
+            return_exceptions=True
+        )
+
+        images = {}
+        for entry, check in zip(pending, checks):
+            if isinstance(check, Exception):
+                entry["error"] = "Not a valid image"
+                continue
+
+            content_type, phash = check
+            image_data = {
+                "id": str(ObjectId()),
+                "filename": entry["filename"],
+                "content": Binary(entry["content"]),
+                "description": entry["description"] or description,
+                "content_type": content_type,
+                "phash": phash
+            }
+            entry["image_id"] = image_data["id"]
+            images[f"images.{image_data['id']}"] = image_data
+
+        stopped = False
+        if images:
+            error = None
+            try:
+                result = await db["users"].update_one({"_id": user_id}, {"$set": images})
+                if result.modified_count == 0:
+                    error = "Failed to store image"
+            except (PyMongoError, InvalidDocument) as e:
+                # Usually the batch would push the user document past
+                # MongoDB's 16 MB limit, and so would every later one.
+                error = f"Failed to store image: {str(e)}"
+                stopped = True
+
+            if error:
+                for entry in pending:
+                    if "image_id" in entry:
+                        entry["error"] = error
+                        del entry["image_id"]
+            else:
+                for image_data in images.values():
+                    similarity_index.add(user_id, image_data["id"], image_data["phash"])
+
+        for entry in batch:
+            if "image_id" in entry:
+                results.append({"filename": entry["filename"], "image_id": entry["image_id"]})
+            else:
+                results.append({"filename": entry["filename"], "error": entry["error"]})
+
+        if stopped:
+            truncated = await run_in_threadpool(next, entries, None) is not None
+            break
+
+    uploaded = sum(1 for result in results if "image_id" in result)
+    return {
+        "message": f"Uploaded {uploaded} of {len(results)} images",
+        "uploaded": uploaded,
+        "failed": len(results) - uploaded,
+        "truncated": truncated,
+        "results": results
+    }
+
+async def list_images(user_id: str) -> list:
+    """Metadata of every image of a user, leaving the stored bytes in the database."""
+
+    fields = ("filename", "description", "content_type", "phash", "parent_id", "operation", "params")
+    cursor = await db["users"].aggregate([
+        {"$match": {"_id": user_id}},
+        {"$project": {"images": {"$map": {
+            "input": {"$objectToArray": {"$ifNull": ["$images", {}]}},
+            "as": "image",
+            "in": {
+                "id": "$$image.k",
+                **{field: f"$$image.v.{field}" for field in fields},
+                "evicted": {"$eq": [{"$ifNull": ["$$image.v.content", None]}, None]}
+            }
+        }}}}
+    ])
+    user = await cursor.to_list(1)
+    return user[0]["images"] if user else []
+
+def manifest_entry(image: dict) -> dict:
+    entry = {
+        "id": image["id"],
+        "path": image["path"],
+        "filename": image.get("filename"),
+        "description": image.get("description"),
+        "content_type": image.get("content_type"),
+        "phash": image.get("phash")
+    }
+    if image.get("parent_id"):
+        entry["lineage"] = {
+            "parent_id": image["parent_id"],
+            "operation": image["operation"],
+            "params": {k: v for k, v in image["params"].items() if not isinstance(v, bytes)},
+            "evicted": image["evicted"]
+        }
+    return entry
+
+def add_member(archive, name: str, content: bytes, mtime: float):
+    if isinstance(archive, zipfile.ZipFile):
+        info = zipfile.ZipInfo(name, time.localtime(mtime)[:6])
+        info.external_attr = 0o644 << 16
+        archive.writestr(info, content)
+    else:
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        info.mtime = int(mtime)
+        archive.addfile(info, BytesIO(content))
+
+async def export_images(user_id: str, format: str = "tar"):
+    """
+    Async generator of a tar or zip archive of a user's library: manifest.json
+    first, then one member per image. Images are fetched and written one at a
+    time, so memory stays at about one image however large the library is.
+    Evicted derivatives have no member; the manifest keeps their lineage.
+    """
+
+    chunks = []
+    sink = ChunkWriter(chunks.append)
+    if format == "zip":
+        archive = zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED)
+    else:
+        archive = tarfile.open(fileobj=sink, mode="w|")
+
+    images = await list_images(user_id)
+    for image in images:
+        image["path"] = f"images/{image['id']}-{os.path.basename(image.get('filename') or '') or 'image'}"
+
+    manifest = json.dumps({"images": [manifest_entry(image) for image in images]}, indent=2).encode()
+    add_member(archive, MANIFEST_NAME, manifest, time.time())
+
+    for image in images:
+        if image["evicted"]:
+            continue
+
+        user = await db["users"].find_one({"_id": user_id}, {f"images.{image['id']}.content": 1})
+        content = ((user or {}).get("images") or {}).get(image["id"], {}).get("content")
+        if content is None:
+            continue
+
+        add_member(archive, image["path"], bytes(content), ObjectId(image["id"]).generation_time.timestamp())
+        for chunk in chunks:
+            yield chunk
+        chunks.clear()
+
+    archive.close()
+    sink.close()
+    for chunk in chunks:
+        yield chunk
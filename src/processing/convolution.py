@@ -0,0 +1,135 @@
+from PIL import Image, ImageFilter
+import numpy as np
+
+# Largest custom kernel side; a dense 15x15 pass is already 225 taps per pixel.
+MAX_KERNEL_SIZE = 15
+MAX_RADIUS = 250
+# Relative singular value under which a kernel component is treated as noise.
+RANK_TOLERANCE = 1e-6
+
+def filterable_mode(mode: str) -> str:
+    """The mode filterable converts `mode` to, taking any palette as transparent."""
+
+    return {"P": "RGBA", "1": "L"}.get(mode, mode)
+
+def filterable(image: Image.Image) -> Image.Image:
+    """Convert palette and bilevel images to a mode the blur filters accept."""
+
+    if image.mode == "P":
+        return image.convert("RGBA" if "transparency" in image.info else "RGB")
+    if image.mode == "1":
+        return image.convert("L")
+    return image
+
+def gaussian_blur(image: Image.Image, radius: float) -> Image.Image:
+    # Pillow approximates the Gaussian with three running-sum box passes per
+    # axis, so the cost per pixel doesn't depend on the radius.
+    return filterable(image).filter(ImageFilter.GaussianBlur(radius))
+
+def box_blur(image: Image.Image, radius: float) -> Image.Image:
+    # A running sum per axis: constant cost per pixel at any radius.
+    return filterable(image).filter(ImageFilter.BoxBlur(radius))
+
+def unsharp_mask(image: Image.Image, radius: float, percent: int, threshold: int) -> Image.Image:
+    # The blurred copy comes from the same box-pass Gaussian as gaussian_blur.
+    return filterable(image).filter(ImageFilter.UnsharpMask(radius, percent, threshold))
+
+def parse_kernel(text: str) -> np.ndarray:
+    """
+    Parse a kernel written as rows separated by ";" and values by ",",
+    e.g. "1,2,1;2,4,2;1,2,1". Both sides must be odd and at most MAX_KERNEL_SIZE.
+    """
+
+    rows = [[float(value) for value in row.split(",")] for row in text.split(";")]
+    if len({len(row) for row in rows}) != 1:
+        raise ValueError("Kernel rows must all have the same length")
+
+    kernel = np.array(rows, dtype=np.float64)
+    height, width = kernel.shape
+    if height % 2 == 0 or width % 2 == 0 or max(height, width) > MAX_KERNEL_SIZE:
+        raise ValueError(f"Kernel sides must be odd and at most {MAX_KERNEL_SIZE}")
+    return kernel
+
+def decompose(kernel: np.ndarray) -> list:
+    """
+    Split a kernel into (column, row) pairs whose outer products sum to it.
+    A separable kernel gives a single pair, so it costs h + w taps per pixel
+    instead of h * w; other kernels give one pair per significant singular value.
+    """
+
+    u, s, vt = np.linalg.svd(kernel)
+    pairs = []
+    for i in range(len(s)):
+        if s[i] <= s[0] * RANK_TOLERANCE:
+            break
+        scale = np.sqrt(s[i])
+        pairs.append((u[:, i] * scale, vt[i] * scale))
+    return pairs
+
+def convolve_axis(array: np.ndarray, taps: np.ndarray, axis: int) -> np.ndarray:
+    """One-dimensional convolution along an axis, repeating the edge pixels."""
+
+    radius = len(taps) // 2
+    padding = [(0, 0)] * array.ndim
+    padding[axis] = (radius, radius)
+    padded = np.pad(array, padding, mode="edge")
+
+    length = array.shape[axis]
+    output = np.zeros_like(array)
+    for i, tap in enumerate(taps[::-1]):
+        if tap:
+            window = [slice(None)] * array.ndim
+            window[axis] = slice(i, i + length)
+            output += np.float32(tap) * padded[tuple(window)]
+    return output
+
+def convolve_2d(array: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    """Direct two-dimensional convolution, repeating the edge pixels."""
+
+    radius_y, radius_x = kernel.shape[0] // 2, kernel.shape[1] // 2
+    padding = [(radius_y, radius_y), (radius_x, radius_x)] + [(0, 0)] * (array.ndim - 2)
+    padded = np.pad(array, padding, mode="edge")
+
+    height, width = array.shape[:2]
+    output = np.zeros_like(array)
+    for (y, x), tap in np.ndenumerate(kernel[::-1, ::-1]):
+        if tap:
+            output += np.float32(tap) * padded[y:y + height, x:x + width]
+    return output
+
+def convolve(image: Image.Image, kernel: np.ndarray, scale: float = None, offset: float = 0) -> Image.Image:
+    """
+    Convolve with an arbitrary kernel. When the kernel splits into few enough
+    components, each runs as two one-dimensional passes; otherwise the kernel
+    is applied directly. This is a true convolution (the kernel is flipped on
+    both axes). Like ImageFilter.Kernel, the sum is divided by
+    `scale` (the kernel sum by default) and `offset` is added. Alpha is kept.
+    """
+
+    image = filterable(image)
+    if image.mode not in ("L", "LA", "RGB", "RGBA"):
+        image = image.convert("RGB")
+
+    if scale is None:
+        scale = kernel.sum() or 1.0
+
+    has_alpha = image.mode in ("LA", "RGBA")
+    array = np.asarray(image).astype(np.float32)
+    color = array[..., :-1] if has_alpha else array
+
+    kernel = kernel / scale
+    pairs = decompose(kernel)
+    if len(pairs) * sum(kernel.shape) < kernel.size:
+        output = np.zeros_like(color)
+        for column, row in pairs:
+            output += convolve_axis(convolve_axis(color, column, 0), row, 1)
+    else:
+        output = convolve_2d(color, kernel)
+    output += offset
+    np.rint(output, out=output)
+    np.clip(output, 0, 255, out=output)
+    output = output.astype(np.uint8)
+
+    if has_alpha:
+        output = np.dstack((output, array[..., -1].astype(np.uint8)))
+    return Image.fromarray(output, image.mode)
@@ -0,0 +1,154 @@
+from fastapi import HTTPException
+from mongo.database_handler import db
+from models import UserInDB
+from bson.objectid import ObjectId
+from bson.binary import Binary
+from processing.operations import render
+from processing.memory import estimate_memory
+from processing.scheduler import scheduler, estimate_cost
+from processing.similarity import similarity_index, hash_image
+import asyncio
+
+# Regenerations in progress, keyed by (user id, image id).
+regenerations = {}
+
+async def save_derivative(user_id: str, parent_id: str, operation: str, params: dict, content: bytes, content_type: str, filename: str) -> str:
+    """Store an operation result as a new image that remembers how it was produced."""
+
+    image_data = {
+        "id": str(ObjectId()),
+        "filename": filename,
+        "content": Binary(content),
+        "description": None,
+        "content_type": content_type,
+        "parent_id": parent_id,
+        "operation": operation,
+        "params": params,
+        "phash": await hash_image(content)
+    }
+
+    result = await db["users"].update_one(
+        {"_id": user_id},
+        {"$set": {f"images.{image_data['id']}": image_data}}
+    )
+
+    if result.modified_count == 0:
+        raise HTTPException(status_code=400, detail="Failed to save image")
+
+    similarity_index.add(user_id, image_data["id"], image_data["phash"])
+
+    return image_data["id"]
+
+async def load_content(user: dict, image_id: str) -> bytes:
+    """
+    Return the stored bytes of an image, regenerating them from the parent
+    when a derivative's content has been evicted.
+    """
+
+    images = user.get("images") or {}
+    if image_id not in images:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    image_data = images[image_id]
+    if image_data.get("content") is not None:
+        return image_data["content"]
+
+    if image_data.get("parent_id") not in images:
+        raise HTTPException(status_code=410, detail="Image content was evicted and can't be regenerated")
+
+    # Concurrent reads of the same evicted image share one regeneration.
+    key = (user["_id"], image_id)
+    regeneration = regenerations.get(key)
+    if regeneration is None:
+        regeneration = asyncio.ensure_future(regenerate(user, image_id))
+        regenerations[key] = regeneration
+        regeneration.add_done_callback(lambda task: forget_regeneration(key, task))
+
+    content = await asyncio.shield(regeneration)
+    image_data["content"] = content
+    return content
+
+async def regenerate(user: dict, image_id: str) -> bytes:
+    """Render an evicted image from its parent on the scheduler and store the result."""
+
+    image_data = user["images"][image_id]
+    parent_content = await load_content(user, image_data["parent_id"])
+
+    memory = estimate_memory(parent_content, image_data["operation"], image_data["params"])
+    try:
+        content, _ = await scheduler.run(
+            UserInDB(**user), estimate_cost(parent_content),
+            render, parent_content, image_data["operation"], image_data["params"],
+            memory=memory
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(500, detail=f"Image regeneration failed: {str(e)}")
+
+    await db["users"].update_one(
+        {"_id": user["_id"]},
+        {"$set": {f"images.{image_id}.content": Binary(content)}}
+    )
+
+    return content
+
+def forget_regeneration(key: tuple, task: asyncio.Task):
+    if regenerations.get(key) is task:
+        del regenerations[key]
+    # Mark a failure as seen when every reader has gone away.
+    if not task.cancelled():
+        task.exception()
+
+def regeneration_chain(images: dict, image_id: str) -> list | None:
+    """
+    Ancestors an image's content would be regenerated through, up to the
+    first one with stored bytes, or None if the chain is broken.
+    """
+
+    chain = []
+    parent_id = images[image_id].get("parent_id")
+    while parent_id:
+        if parent_id not in images or parent_id in chain:
+            return None
+        chain.append(parent_id)
+        if images[parent_id].get("content") is not None:
+            return chain
+        parent_id = images[parent_id].get("parent_id")
+    return None
+
+async def evict_content(user_id: str, image_id: str):
+    """Drop the stored bytes of a derivative, keeping its lineage so it can be regenerated."""
+
+    user = await db["users"].find_one({"_id": user_id})
+    images = (user or {}).get("images") or {}
+
+    if image_id not in images or not images[image_id].get("parent_id"):
+        raise HTTPException(status_code=404, detail="Derived image not found")
+
+    chain = regeneration_chain(images, image_id)
+    if chain is None:
+        raise HTTPException(status_code=409, detail="Image's parent is gone, so evicted content couldn't be regenerated")
+
+    # Only evict while every image the content would be rebuilt from still exists.
+    result = await db["users"].update_one(
+        {
+            "_id": user_id,
+            f"images.{image_id}.parent_id": {"$exists": True},
+            **{f"images.{ancestor_id}": {"$exists": True} for ancestor_id in chain}
+        },
+        {"$set": {f"images.{image_id}.content": None}}
+    )
+
+    if result.matched_count == 0:
+        raise HTTPException(status_code=409, detail="Image's lineage changed while evicting; try again")
+
+async def restore_children(user: dict, image_id: str):
+    """
+    Regenerate the evicted derivatives of an image that is about to be
+    deleted, as they can't be rebuilt once it is gone.
+    """
+
+    for child_id, child in list(user["images"].items()):
+        if child.get("parent_id") == image_id and child.get("content") is None:
+            await load_content(user, child_id)
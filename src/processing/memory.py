@@ -0,0 +1,100 @@
+from fastapi import HTTPException
+from PIL import Image
+from io import BytesIO
+from collections import deque
+from contextlib import asynccontextmanager
+from processing.operations import operations
+import asyncio
+import os
+
+# Bytes of decoded image data all requests together may hold. Set it to the
+# worker's RSS ceiling minus what the process needs when idle.
+IMAGE_MEMORY_BUDGET = int(os.getenv("IMAGE_MEMORY_BUDGET_MB", 1024)) * 1024 * 1024
+# How long a request waits for memory to free up before getting a 503.
+IMAGE_MEMORY_WAIT_SECONDS = float(os.getenv("IMAGE_MEMORY_WAIT_SECONDS", 10))
+
+def estimate_memory(content: bytes, operation: str, params: dict) -> int:
+    """
+    Estimate the peak memory of running an operation, from the image header
+    alone. The bytes stay resident next to the decoded pixels and the output.
+    """
+
+    op = operations[operation]
+    try:
+        header = Image.open(BytesIO(content))
+        if op["draft"]:
+            header.draft(header.mode, op["draft"](header.size, params))
+        width, height = header.size
+    except Exception:
+        return 2 * len(content)
+
+    return len(content) + op["memory"](width, height, header.mode, params)
+
+class MemoryBudget:
+    """
+    Admission control for decoded image memory. Reservations are granted in
+    arrival order, so a large image isn't starved by a stream of small ones.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.reserved = 0
+        self.waiters = deque()
+
+    async def reserve(self, amount: int):
+        if amount > self.limit:
+            raise HTTPException(status_code=503, detail="Image is too large to process")
+
+        if not self.waiters and self.reserved + amount <= self.limit:
+            self.reserved += amount
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (amount, waiter)
+        self.waiters.append(entry)
+        try:
+            await asyncio.wait_for(waiter, IMAGE_MEMORY_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            self.forget(entry)
+            raise HTTPException(
+                status_code=503,
+                detail="Server is out of memory for image processing",
+                headers={"Retry-After": str(max(1, round(IMAGE_MEMORY_WAIT_SECONDS)))},
+            )
+        except asyncio.CancelledError:
+            # Granted just as we were cancelled: hand the memory back.
+            if waiter.done() and not waiter.cancelled():
+                self.release(amount)
+            self.forget(entry)
+            raise
+
+    def release(self, amount: int):
+        self.reserved -= amount
+        self.wake()
+
+    def forget(self, entry):
+        if entry in self.waiters:
+            self.waiters.remove(entry)
+            self.wake()
+
+    def wake(self):
+        while self.waiters:
+            amount, waiter = self.waiters[0]
+            if waiter.done():
+                self.waiters.popleft()
+                continue
+            if self.reserved + amount > self.limit:
+                return
+            self.waiters.popleft()
+            self.reserved += amount
+            waiter.set_result(None)
+
+    @asynccontextmanager
+    async def reservation(self, amount: int):
+        await self.reserve(amount)
+        try:
+            yield
+        finally:
+            self.release(amount)
+
+memory_budget = MemoryBudget(IMAGE_MEMORY_BUDGET)
@@ -0,0 +1,117 @@
+from fastapi import HTTPException
+from PIL import Image
+from io import BytesIO
+import inspect
+
+# Registry of named image operations. Routers register the pixel work behind
+# each endpoint here so a stored derivative can be replayed from its lineage.
+operations = {}
+
+def default_output(params: dict) -> tuple:
+    return "PNG", {}
+
+# Pillow stores every multi-band mode at four bytes per pixel, padding
+# RGB, LA and the like; single-band modes take one byte unless wider.
+wide_modes = {"I": 4, "F": 4, "I;16": 2, "I;16B": 2, "I;16L": 2, "I;16N": 2}
+
+def pixel_size(mode: str) -> int:
+    """Bytes Pillow stores a pixel of `mode` in."""
+
+    if Image.getmodebands(mode) > 1:
+        return 4
+    return wide_modes.get(mode, 1)
+
+def default_memory(width: int, height: int, mode: str, params: dict) -> int:
+    # The decoded input and an output of the same size.
+    return 2 * width * height * pixel_size(mode)
+
+# Types a param may arrive as for each annotation; links carry plain JSON values.
+param_types = {int: int, float: (int, float), bool: bool, str: str, bytes: bytes}
+
+def operation(name: str, output=default_output, fast_path=None, memory=default_memory, draft=None, validate=None):
+    """
+    Register an image operation.
+    - **name**: Operation name stored in lineage metadata (e.g. "filter/sepia").
+    - **output**: Callable returning the (format, save options) used to encode the result.
+    - **fast_path**: Optional callable working on the encoded bytes; it returns
+      (encoded bytes, format), or None to fall back to decoding.
+    - **memory**: Callable estimating peak bytes from (width, height, mode, params)
+      of the decoded image.
+    - **draft**: Optional callable returning the size the operation drafts the
+      decode to from (size, params), so JPEGs are sized at their reduced scale.
+    - **validate**: Optional callable given the params with defaults filled in.
+      It raises HTTPException for values the operation can't take.
+    """
+
+    def decorator(apply):
+        operations[name] = {"apply": apply, "output": output, "fast_path": fast_path, "memory": memory, "draft": draft, "validate": validate}
+        return apply
+
+    return decorator
+
+def validate_params(name: str, params: dict):
+    """
+    Check params for a registered operation the way its endpoint would:
+    their names and types against the operation's signature, then its
+    validate hook. Raises HTTPException.
+    """
+
+    op = operations[name]
+    signature = inspect.signature(op["apply"])
+
+    try:
+        bound = signature.bind(None, **params)
+    except TypeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid operation params: {str(e)}")
+    bound.apply_defaults()
+
+    arguments = dict(list(bound.arguments.items())[1:])
+    for param_name, value in arguments.items():
+        parameter = signature.parameters[param_name]
+        if value is None and parameter.default is None:
+            continue
+        expected = param_types.get(parameter.annotation)
+        if expected and (not isinstance(value, expected) or (isinstance(value, bool) and parameter.annotation is not bool)):
+            raise HTTPException(status_code=400, detail=f"{param_name} must be of type {parameter.annotation.__name__}")
+
+    if op["validate"]:
+        op["validate"](arguments)
+
+def prepare(content: bytes, name: str, params: dict) -> tuple:
+    """
+    Apply a registered operation to encoded image bytes and return
+    (result, format, save options). The result is an image still to be
+    encoded, or bytes when a fast path already produced the output.
+    """
+
+    op = operations[name]
+
+    if op["fast_path"]:
+        result = op["fast_path"](content, **params)
+        if result is not None:
+            output, format = result
+            return output, format, {}
+
+    original_image = Image.open(BytesIO(content))
+
+    modified_image = op["apply"](original_image, **params)
+
+    format, options = op["output"](params)
+    return modified_image, format, options
+
+def encode(result, format: str, options: dict, fp):
+    """Write a prepared result to a file object."""
+
+    if isinstance(result, bytes):
+        fp.write(result)
+    else:
+        result.save(fp, format=format, **options)
+
+def render(content: bytes, name: str, params: dict) -> tuple:
+    """Apply a registered operation to encoded image bytes and return (encoded bytes, format)."""
+
+    result, format, options = prepare(content, name, params)
+
+    output_buffer = BytesIO()
+    encode(result, format, options, output_buffer)
+    return output_buffer.getvalue(), format
@@ -0,0 +1,76 @@
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from mongo.database_handler import db
+from models import UserInDB
+from processing.streaming import render_stream
+from processing.lineage import load_content, save_derivative
+from processing.scheduler import scheduler, estimate_cost
+from processing.memory import estimate_memory
+from processing.singleflight import SingleFlight, flight_key
+from processing.operations import validate_params
+import asyncio
+import os
+
+# How long encoding waits for a reader to take the next chunk before the
+# reader is cut off. Encoding holds a worker and its memory reservation
+# while it waits, so this bounds how long a stalled client can keep them.
+IMAGE_SEND_TIMEOUT_SECONDS = float(os.getenv("IMAGE_SEND_TIMEOUT_SECONDS", 10))
+
+# Identical requests arriving together share one fetch, decode and encode.
+flights = SingleFlight(timeout=IMAGE_SEND_TIMEOUT_SECONDS)
+
+async def compute_image(publish, ImageId: str, user_id: str, operation: str, params: dict):
+    """Fetch an image and run an operation on it, publishing the output format and then encoded chunks."""
+
+    user = await db["users"].find_one({"_id": user_id})
+
+    if not user or "images" not in user or ImageId not in user["images"]:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    content = await load_content(user, ImageId)
+
+    loop = asyncio.get_running_loop()
+
+    def send(item):
+        asyncio.run_coroutine_threadsafe(publish(item), loop).result()
+
+    try:
+        memory = estimate_memory(content, operation, params)
+        await scheduler.run(UserInDB(**user), estimate_cost(content), render_stream, send, content, operation, params, memory=memory)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(400, detail=f"Image processing failed: {str(e)}")
+
+async def process_image(ImageId: str, user_id: str, operation: str, params: dict, filename: str, save: bool = False, headers: dict = None):
+    """
+    Run a registered operation on one of a user's images.
+    - **filename**: Name of the result without extension; the output format supplies it.
+    - **save**: Store the result as a new image with lineage instead of streaming it back.
+    - **headers**: Extra response headers.
+    """
+
+    validate_params(operation, params)
+
+    key = flight_key(user_id, ImageId, operation, params=params)
+    stream = flights.join(key, compute_image, ImageId, user_id, operation, params)
+
+    # Errors up to the start of encoding surface here, before any response is sent.
+    format = await anext(stream)
+
+    media_type = f"image/{format.casefold()}"
+    filename = f"{filename}.{format.casefold()}"
+
+    if save:
+        output = b"".join([chunk async for chunk in stream])
+        new_id = await save_derivative(user_id, ImageId, operation, params, output, media_type, filename)
+        return {"message": "Image saved successfully", "image_id": new_id}
+
+    return StreamingResponse(
+        stream,
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f"inline; filename={filename}",
+            **(headers or {})
+        }
+    )
@@ -0,0 +1,63 @@
+from PIL import Image
+
+resampling_filters = {
+    "nearest": Image.Resampling.NEAREST,
+    "box": Image.Resampling.BOX,
+    "bilinear": Image.Resampling.BILINEAR,
+    "hamming": Image.Resampling.HAMMING,
+    "bicubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS,
+}
+
+# stretch ignores the aspect ratio, fit stays inside the box, fill fits and pads
+# to the exact box and cover fills the box and trims the overflow.
+resize_modes = ("stretch", "fit", "fill", "cover")
+
+# Reduce by whole factors until the remaining resample is under this ratio.
+# Pillow recommends 2.0-3.0; 3.0 is indistinguishable from a full resample.
+REDUCING_GAP = 3.0
+
+def scaled_size(size: tuple, width: int, height: int, mode: str) -> tuple:
+    """Return the size the whole image is scaled to before any padding or trimming."""
+
+    w, h = size
+    if mode == "stretch":
+        return width, height
+
+    scale = min(width / w, height / h) if mode in ("fit", "fill") else max(width / w, height / h)
+    return max(1, round(w * scale)), max(1, round(h * scale))
+
+def downscale(image: Image.Image, width: int, height: int, mode: str = "stretch", resample: str = "bicubic", fill: str = None) -> Image.Image:
+    """
+    Resize an image into a width x height box, doing as little work as possible.
+    JPEGs are decoded straight at a reduced DCT scale with `draft`, then
+    `reducing_gap` shrinks by whole factors with `reduce` before the final
+    resample. Must be given an image that hasn't been loaded yet.
+    """
+
+    target = scaled_size(image.size, width, height, mode)
+
+    # No-op for anything but a not yet loaded JPEG; keeps both sides >= target.
+    image.draft(image.mode, target)
+
+    # Coordinates below are in the drafted image, which may be 1/2-1/8 smaller.
+    drafted_w, drafted_h = image.size
+    box = (0, 0, drafted_w, drafted_h)
+    size = target
+
+    if mode == "cover":
+        crop_w = width * drafted_w / target[0]
+        crop_h = height * drafted_h / target[1]
+        left = (drafted_w - crop_w) / 2
+        top = (drafted_h - crop_h) / 2
+        box = (left, top, left + crop_w, top + crop_h)
+        size = (width, height)
+
+    result = image.resize(size, resampling_filters[resample], box=box, reducing_gap=REDUCING_GAP)
+
+    if mode == "fill" and result.size != (width, height):
+        canvas = Image.new(result.mode, (width, height), fill or 0)
+        canvas.paste(result, ((width - result.width) // 2, (height - result.height) // 2))
+        result = canvas
+
+    return result
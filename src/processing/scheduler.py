@@ -0,0 +1,153 @@
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+from models import UserInDB
+from processing.memory import memory_budget
+from PIL import Image
+from io import BytesIO
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+
+# Image work running at once across all users.
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", os.cpu_count() or 1))
+# Requests a user may have running or queued before getting a 429, unless
+# their user record sets max_in_flight.
+DEFAULT_MAX_IN_FLIGHT = int(os.getenv("IMAGE_MAX_IN_FLIGHT", 4))
+# Smallest cost charged per request, in megapixels.
+MIN_COST = 0.1
+
+def estimate_cost(content: bytes) -> float:
+    """Estimate the cost of processing an image, in megapixels, from its header alone."""
+
+    try:
+        width, height = Image.open(BytesIO(content)).size
+    except Exception:
+        return 1.0
+    return max(width * height / 1_000_000, MIN_COST)
+
+class FairScheduler:
+    """
+    Start-time fair queuing of image work across users.
+
+    Every request is tagged with a virtual start time: the later of the global
+    virtual clock and the finish time of the same user's previous request,
+    where a request "finishes" cost / weight after it starts. Free workers
+    always go to the smallest start tag. A user firing requests in a loop only
+    pushes their own tags further out, so others are served in between, and a
+    user with weight 2 gets twice the megapixels per second of a user with 1.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.running = 0
+        self.virtual_time = 0.0
+        self.queue = []
+        self.sequence = itertools.count()
+        self.finish_tags = {}
+        self.in_flight = {}
+        self.in_flight_cost = {}
+        # Moving average used to turn queued megapixels into a Retry-After.
+        self.seconds_per_megapixel = 0.05
+
+    async def run(self, user: UserInDB, cost: float, fn, *args, memory: int = 0, capped: bool = True):
+        """
+        Run fn(*args) in a worker thread once the user's turn comes up and
+        `memory` bytes have been reserved against the global memory budget.
+        With capped=False the user's max_in_flight doesn't apply, for work
+        fanned out from a single request that was already admitted.
+        """
+
+        user_id = user.id
+        weight = user.weight if user.weight and user.weight > 0 else 1.0
+        max_in_flight = user.max_in_flight or DEFAULT_MAX_IN_FLIGHT
+
+        if capped and self.in_flight.get(user_id, 0) >= max_in_flight:
+            raise HTTPException(
+                status_code=429,
+                detail="Too many image requests in progress",
+                headers={"Retry-After": str(self.retry_after(user_id, weight))},
+            )
+
+        start = max(self.virtual_time, self.finish_tags.get(user_id, 0.0))
+        self.finish_tags[user_id] = start + cost / weight
+        self.in_flight[user_id] = self.in_flight.get(user_id, 0) + 1
+        self.in_flight_cost[user_id] = self.in_flight_cost.get(user_id, 0.0) + cost
+
+        try:
+            await self.acquire(start)
+            try:
+                await memory_budget.reserve(memory)
+            except BaseException:
+                self.release()
+                raise
+        except BaseException:
+            self.finish(user_id, cost)
+            raise
+
+        started = time.monotonic()
+        work = asyncio.ensure_future(run_in_threadpool(fn, *args))
+
+        def done(work):
+            # Mark a failure as seen when nobody is left awaiting it.
+            if not work.cancelled():
+                work.exception()
+            self.observe(cost, time.monotonic() - started)
+            memory_budget.release(memory)
+            self.release()
+            self.finish(user_id, cost)
+
+        # The thread can't be interrupted, so a cancelled request keeps its
+        # worker, memory and place in the user's quota until the thread
+        # really finishes.
+        work.add_done_callback(done)
+        return await asyncio.shield(work)
+
+    def finish(self, user_id: str, cost: float):
+        self.in_flight[user_id] -= 1
+        self.in_flight_cost[user_id] -= cost
+        if self.in_flight[user_id] == 0:
+            del self.in_flight[user_id]
+            del self.in_flight_cost[user_id]
+            if self.finish_tags[user_id] <= self.virtual_time:
+                del self.finish_tags[user_id]
+
+    async def acquire(self, start: float):
+        if self.running < self.workers and not self.queue:
+            self.running += 1
+            self.virtual_time = max(self.virtual_time, start)
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (start, next(self.sequence), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # Handed a worker just as we were cancelled: pass it on.
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            waiter.cancel()
+            raise
+
+    def release(self):
+        while self.queue:
+            start, _, waiter = heapq.heappop(self.queue)
+            if waiter.done():
+                continue
+            self.virtual_time = max(self.virtual_time, start)
+            waiter.set_result(None)
+            return
+        self.running -= 1
+
+    def observe(self, cost: float, seconds: float):
+        self.seconds_per_megapixel = 0.9 * self.seconds_per_megapixel + 0.1 * seconds / cost
+
+    def retry_after(self, user_id: str, weight: float) -> int:
+        """Seconds until the user's queued work has likely drained."""
+
+        queued = self.in_flight_cost.get(user_id, 0.0)
+        return max(1, math.ceil(queued * self.seconds_per_megapixel / weight))
+
+scheduler = FairScheduler(IMAGE_WORKERS)
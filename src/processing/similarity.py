@@ -0,0 +1,242 @@
+from PIL import Image
+from io import BytesIO
+from starlette.concurrency import run_in_threadpool
+from fastapi import HTTPException
+from mongo.database_handler import db
+from processing.memory import memory_budget
+from processing.operations import pixel_size
+from functools import lru_cache
+from itertools import combinations
+import numpy as np
+import asyncio
+import math
+
+# pHash: the sign pattern of the 8x8 lowest frequencies of a 32x32 DCT.
+HASH_SIZE = 8
+SAMPLE_SIZE = 32
+
+def dct_matrix(size: int) -> np.ndarray:
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+DCT = dct_matrix(SAMPLE_SIZE)
+
+def perceptual_hash(content: bytes) -> str | None:
+    """
+    64-bit pHash of an encoded image as 16 hex digits, or None if the bytes
+    aren't an image. Recompressed, resized and lightly edited copies land
+    within a few bits of each other.
+    """
+
+    try:
+        image = Image.open(BytesIO(content))
+        image.draft("L", (SAMPLE_SIZE * 4, SAMPLE_SIZE * 4))
+        sample = image.convert("L").resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.Resampling.LANCZOS)
+    except Exception:
+        return None
+
+    frequencies = DCT @ np.asarray(sample, dtype=np.float64) @ DCT.T
+    low = frequencies[:HASH_SIZE, :HASH_SIZE].flatten()
+    # The DC term only encodes overall brightness, so keep it out of the median.
+    bits = low > np.median(low[1:])
+
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return f"{value:016x}"
+
+def hash_memory(content: bytes) -> int:
+    """Peak bytes of hashing an image: the decode, after JPEG draft scaling, and its grayscale copy."""
+
+    try:
+        header = Image.open(BytesIO(content))
+        header.draft("L", (SAMPLE_SIZE * 4, SAMPLE_SIZE * 4))
+        width, height = header.size
+        pixel_bytes = pixel_size(header.mode)
+    except Exception:
+        return 2 * len(content)
+
+    return len(content) + width * height * (pixel_bytes + 1)
+
+async def hash_image(content: bytes) -> str | None:
+    """
+    perceptual_hash in a worker thread, reserved against the memory budget.
+    The hash is optional, so an image that can't get the memory is stored
+    without one for backfill_hashes to pick up later.
+    """
+
+    try:
+        async with memory_budget.reservation(hash_memory(content)):
+            return await run_in_threadpool(perceptual_hash, content)
+    except HTTPException:
+        return None
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+# Multi-index hashing splits each hash into segments with a table apiece.
+SEGMENTS = 4
+SEGMENT_BITS = 64 // SEGMENTS
+SEGMENT_MASK = (1 << SEGMENT_BITS) - 1
+
+def segment(value: int, index: int) -> int:
+    return (value >> (index * SEGMENT_BITS)) & SEGMENT_MASK
+
+def probe_count(radius: int) -> int:
+    return sum(math.comb(SEGMENT_BITS, bits) for bits in range(min(radius, SEGMENT_BITS) + 1))
+
+@lru_cache(maxsize=8)
+def segment_flips(radius: int) -> list:
+    """Every segment-wide mask with at most `radius` bits set."""
+
+    return [
+        sum(1 << bit for bit in bits)
+        for count in range(min(radius, SEGMENT_BITS) + 1)
+        for bits in combinations(range(SEGMENT_BITS), count)
+    ]
+
+class MultiIndexHash:
+    """
+    Multi-index hash table over Hamming distance. Each hash is split into
+    SEGMENTS segments, and each segment has a table from its value to the
+    hashes that have it. By the pigeonhole principle a hash within
+    max_distance of the query is within max_distance // SEGMENTS bits of
+    it in at least one segment. A search looks up those segment values and
+    checks only the hashes found there. Once that would take more lookups
+    than there are hashes, it compares every hash instead.
+    """
+
+    def __init__(self):
+        self.tables = [{} for _ in range(SEGMENTS)]
+        self.ids = {}
+        self.size = 0
+
+    def add(self, value: int, image_id: str):
+        self.size += 1
+        if value in self.ids:
+            self.ids[value].append(image_id)
+            return
+
+        self.ids[value] = [image_id]
+        for index, table in enumerate(self.tables):
+            table.setdefault(segment(value, index), []).append(value)
+
+    def search(self, value: int, max_distance: int) -> list:
+        """Return (distance, image id) pairs within max_distance of value."""
+
+        radius = max_distance // SEGMENTS
+        if SEGMENTS * probe_count(radius) >= len(self.ids):
+            candidates = self.ids
+        else:
+            candidates = set()
+            for index, table in enumerate(self.tables):
+                key = segment(value, index)
+                for flip in segment_flips(radius):
+                    candidates.update(table.get(key ^ flip, ()))
+
+        found = []
+        for candidate in candidates:
+            distance = hamming(value, candidate)
+            if distance <= max_distance:
+                found.extend((distance, image_id) for image_id in self.ids[candidate])
+        return found
+
+class SimilarityIndex:
+    """
+    Per-user multi-index hash tables of image hashes, built on first use and
+    kept in step by add and discard as images are stored and deleted.
+    Deletions are filtered out of results until they make up half the
+    table, which is then rebuilt. The index also counts each user's images and hashed images, so
+    changes made by another process show up as a count mismatch and
+    trigger a rebuild.
+    """
+
+    def __init__(self):
+        self.tables = {}
+        self.hashes = {}
+        self.counts = {}
+
+    def ensure(self, user_id: str, images: dict, image_id: str):
+        """
+        Build a user's table, or rebuild it when it is out of step with their
+        stored images: a different number of images or of hashed images, a
+        query image it doesn't know or too many deletions. Hashes added in
+        place, by backfill_hashes or another process, change only the
+        hashed count.
+        """
+
+        hashed = sum(1 for data in images.values() if data.get("phash"))
+        if (
+            user_id not in self.tables
+            or self.counts[user_id] != len(images)
+            or len(self.hashes[user_id]) != hashed
+            or self.hashes[user_id].get(image_id) != images[image_id].get("phash")
+            or self.tables[user_id].size > 2 * len(self.hashes[user_id])
+        ):
+            self.build(user_id, images)
+
+    def build(self, user_id: str, images: dict):
+        table = MultiIndexHash()
+        hashes = {}
+        for image_id, data in images.items():
+            if data.get("phash"):
+                table.add(int(data["phash"], 16), image_id)
+                hashes[image_id] = data["phash"]
+        self.tables[user_id] = table
+        self.hashes[user_id] = hashes
+        self.counts[user_id] = len(images)
+
+    def add(self, user_id: str, image_id: str, value: str | None):
+        """Record a newly stored image; value is None when it has no hash."""
+
+        if user_id not in self.tables:
+            return
+        self.counts[user_id] += 1
+        if value and self.hashes[user_id].get(image_id) != value:
+            self.tables[user_id].add(int(value, 16), image_id)
+            self.hashes[user_id][image_id] = value
+
+    def discard(self, user_id: str, image_id: str):
+        if user_id in self.tables:
+            self.counts[user_id] -= 1
+            self.hashes[user_id].pop(image_id, None)
+
+    def drop(self, user_id: str):
+        self.tables.pop(user_id, None)
+        self.hashes.pop(user_id, None)
+        self.counts.pop(user_id, None)
+
+    def search(self, user_id: str, value: str, max_distance: int) -> list:
+        live = self.hashes[user_id]
+        return sorted(
+            (distance, image_id)
+            for distance, image_id in self.tables[user_id].search(int(value, 16), max_distance)
+            if image_id in live
+        )
+
+similarity_index = SimilarityIndex()
+
+async def backfill_hashes():
+    """Compute and store the perceptual hash of every stored image that lacks one."""
+
+    async for user in db["users"].find({"images": {"$exists": True}}):
+        for image_id, image_data in user["images"].items():
+            if image_data.get("phash") or image_data.get("content") is None:
+                continue
+
+            value = await hash_image(image_data["content"])
+            if value is None:
+                continue
+
+            await db["users"].update_one(
+                {"_id": user["_id"], f"images.{image_id}": {"$exists": True}},
+                {"$set": {f"images.{image_id}.phash": value}}
+            )
+
+if __name__ == "__main__":
+    # Backfill job for images uploaded before hashing existed:
+    #   cd src && python -m processing.similarity
+    asyncio.run(backfill_hashes())
@@ -0,0 +1,115 @@
+import asyncio
+import hashlib
+
+END = object()
+
+class Flight:
+    def __init__(self):
+        self.task = None
+        self.subscribers = []
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls that share a key into one computation whose
+    output is streamed to every caller.
+
+    The first caller starts `fn(publish, *args)` as a task; callers arriving
+    while it runs join the same flight. Every item the task publishes is handed
+    to each caller through a queue of `depth` items, so the task can't run
+    further ahead of the slowest caller than that. Joining closes with the
+    first item, as later callers would have missed it. An exception from the
+    task is raised in every caller. A caller that goes away only stops
+    reading; the task is cancelled once no caller is left.
+
+    A caller that leaves its queue full for `timeout` seconds is cut off with
+    a TimeoutError, so a stalled reader can't hold the task, and the worker
+    and memory it holds, for longer than that. Once every caller is gone,
+    publishing raises BrokenPipeError and the task stops.
+    """
+
+    def __init__(self, depth: int = 16, timeout: float = None):
+        self.depth = depth
+        self.timeout = timeout
+        self.flights = {}
+
+    async def join(self, key, fn, *args):
+        """Async generator of the items published for `key`."""
+
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = Flight()
+            self.flights[key] = flight
+            flight.task = asyncio.ensure_future(self.run(key, flight, fn, *args))
+
+        queue = asyncio.Queue(self.depth)
+        flight.subscribers.append(queue)
+        try:
+            while True:
+                item = await queue.get()
+                if item is END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self.leave(key, flight, queue)
+
+    async def run(self, key, flight, fn, *args):
+        async def publish(item):
+            self.forget(key, flight)
+            if not flight.subscribers:
+                raise BrokenPipeError("Every caller has gone away")
+            await self.broadcast(flight, item)
+
+        try:
+            await fn(publish, *args)
+        except asyncio.CancelledError:
+            self.forget(key, flight)
+            raise
+        except Exception as e:
+            item = e
+        else:
+            item = END
+
+        # Close joining first: a caller arriving while the broadcast waits on
+        # a slow queue would otherwise never get the last item.
+        self.forget(key, flight)
+        await self.broadcast(flight, item)
+
+    async def broadcast(self, flight, item):
+        for queue in list(flight.subscribers):
+            try:
+                await asyncio.wait_for(queue.put(item), self.timeout)
+            except asyncio.TimeoutError:
+                self.drop(flight, queue)
+
+    def drop(self, flight, queue):
+        if queue in flight.subscribers:
+            flight.subscribers.remove(queue)
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(TimeoutError("Reader stopped reading"))
+
+    def leave(self, key, flight, queue):
+        if queue in flight.subscribers:
+            flight.subscribers.remove(queue)
+        # Unblock the task if it is waiting for room in this queue.
+        while not queue.empty():
+            queue.get_nowait()
+
+        if not flight.subscribers and not flight.task.done():
+            flight.task.cancel()
+            self.forget(key, flight)
+
+    def forget(self, key, flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+def flight_key(*parts, params: dict) -> tuple:
+    """Build a hashable key from operation params, digesting uploaded bytes."""
+
+    canonical = tuple(sorted(
+        (name, hashlib.sha256(value).hexdigest() if isinstance(value, bytes) else value)
+        for name, value in params.items()
+    ))
+    return parts + (canonical,)
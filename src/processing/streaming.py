@@ -0,0 +1,54 @@
+from processing.operations import prepare, encode
+from io import BytesIO
+
+# Size of the pieces encoded output is handed to the response in.
+CHUNK_SIZE = 64 * 1024
+
+# Writers that seek back to patch offsets, so they need a real buffer.
+seeking_formats = {"TIFF"}
+
+class ChunkWriter:
+    """
+    Write-only file object for Image.save that passes fixed-size chunks to
+    `send` as soon as they fill up. `send` blocks while the reader is behind,
+    which holds the encoder back instead of buffering its whole output.
+    """
+
+    def __init__(self, send, chunk_size: int = CHUNK_SIZE):
+        self.send = send
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+
+    def write(self, data) -> int:
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            self.send(bytes(self.buffer[:self.chunk_size]))
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer:
+            self.send(bytes(self.buffer))
+            self.buffer = bytearray()
+
+def render_stream(send, content: bytes, name: str, params: dict):
+    """
+    Apply a registered operation and encode it incrementally. Meant for a
+    worker thread: `send` first receives the output format, then the encoded
+    bytes in chunks while the encoder is still running.
+    """
+
+    result, format, options = prepare(content, name, params)
+    send(format)
+
+    writer = ChunkWriter(send)
+    if format in seeking_formats and not isinstance(result, bytes):
+        output_buffer = BytesIO()
+        encode(result, format, options, output_buffer)
+        writer.write(output_buffer.getbuffer())
+    else:
+        encode(result, format, options, writer)
+    writer.close()
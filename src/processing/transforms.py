@@ -0,0 +1,144 @@
+from PIL import Image
+import struct
+
+ORIENTATION_TAG = 0x0112
+
+# Transpose that displays a stored JPEG for each EXIF Orientation value.
+orientation_transposes = {
+    1: None,
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+right_angles = {
+    90: Image.Transpose.ROTATE_90,
+    180: Image.Transpose.ROTATE_180,
+    270: Image.Transpose.ROTATE_270,
+}
+
+def rotate(image: Image.Image, degrees: int, expand: bool = False, fill: str = None) -> Image.Image:
+    """
+    Rotate counter-clockwise. Right angles are exact transposes that keep every
+    pixel; other angles are resampled, optionally growing the canvas to fit and
+    painting the uncovered corners with `fill`.
+    """
+
+    degrees %= 360
+    if degrees == 0:
+        return image
+    if degrees in right_angles:
+        return image.transpose(right_angles[degrees])
+
+    return image.rotate(degrees, resample=Image.Resampling.BICUBIC, expand=expand, fillcolor=fill)
+
+def crop(image: Image.Image, left: int, top: int, right: int, bottom: int) -> Image.Image:
+    """Cut out a pixel box without any resampling."""
+
+    width, height = image.size
+    if not (0 <= left < right <= width and 0 <= top < bottom <= height):
+        raise ValueError(f"Crop box ({left}, {top}, {right}, {bottom}) must lie inside the {width}x{height} image")
+
+    return image.crop((left, top, right, bottom))
+
+def compose_orientation(orientation: int, method: Image.Transpose) -> int:
+    """Return the Orientation value that displays the stored pixels as `orientation` followed by `method`."""
+
+    # Every orientation is one of eight transposes, so compare them on a tiny
+    # asymmetric probe instead of maintaining a composition table by hand.
+    probe = Image.frombytes("L", (2, 3), bytes(range(6)))
+
+    def show(transpose):
+        shown = probe.transpose(transpose) if transpose is not None else probe
+        return shown.size, shown.tobytes()
+
+    current = orientation_transposes.get(orientation)
+    shown = probe.transpose(current) if current is not None else probe
+    shown = shown.transpose(method)
+    expected = shown.size, shown.tobytes()
+
+    for candidate, transpose in orientation_transposes.items():
+        if show(transpose) == expected:
+            return candidate
+
+def find_exif_segment(content: bytes) -> tuple | None:
+    """Return the (start, end) byte range of a JPEG's EXIF APP1 segment, markers included."""
+
+    i = 2
+    while i + 4 <= len(content) and content[i] == 0xFF:
+        marker = content[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker in (0xDA, 0xD9):
+            break
+
+        length = struct.unpack(">H", content[i + 2:i + 4])[0]
+        if marker == 0xE1 and content[i + 4:i + 10] == b"Exif\x00\x00":
+            return i, i + 2 + length
+        i += 2 + length
+
+    return None
+
+def orientation_offset(content: bytes, start: int, end: int) -> int | None:
+    """Return the position of the Orientation SHORT inside IFD0, if the tag is present."""
+
+    tiff = start + 10
+    try:
+        order = {b"II": "<", b"MM": ">"}[bytes(content[tiff:tiff + 2])]
+        ifd = tiff + struct.unpack(order + "I", content[tiff + 4:tiff + 8])[0]
+        count = struct.unpack(order + "H", content[ifd:ifd + 2])[0]
+
+        for entry in range(ifd + 2, ifd + 2 + 12 * count, 12):
+            if entry + 12 > end:
+                break
+            tag, type = struct.unpack(order + "HH", content[entry:entry + 4])
+            if tag == ORIENTATION_TAG and type == 3:
+                return entry + 8
+    except (KeyError, struct.error):
+        pass
+
+    return None
+
+def reorient_jpeg(content: bytes, method: Image.Transpose) -> bytes | None:
+    """
+    Apply a transpose to a JPEG by rewriting its EXIF Orientation tag, leaving
+    the compressed image data untouched. Returns None when this isn't possible.
+    """
+
+    if not content.startswith(b"\xff\xd8"):
+        return None
+
+    segment = find_exif_segment(content)
+    offset = orientation_offset(content, *segment) if segment else None
+
+    if offset is not None:
+        order = "<" if content[segment[0] + 10:segment[0] + 12] == b"II" else ">"
+        orientation = struct.unpack(order + "H", content[offset:offset + 2])[0]
+        patched = bytearray(content)
+        patched[offset:offset + 2] = struct.pack(order + "H", compose_orientation(orientation, method))
+        return bytes(patched)
+
+    # No Orientation tag to patch: rebuild the APP1 segment around the new tag.
+    exif = Image.Exif()
+    if segment:
+        exif.load(content[segment[0] + 4:segment[1]])
+    exif[ORIENTATION_TAG] = compose_orientation(1, method)
+
+    payload = exif.tobytes()
+    if len(payload) + 2 > 0xFFFF:
+        return None
+    app1 = b"\xff\xe1" + struct.pack(">H", len(payload) + 2) + payload
+
+    if segment:
+        return content[:segment[0]] + app1 + content[segment[1]:]
+
+    # Keep a JFIF APP0 header first, as the JFIF spec requires.
+    insert_at = 2
+    if content[2:4] == b"\xff\xe0":
+        insert_at = 4 + struct.unpack(">H", content[4:6])[0]
+    return content[:insert_at] + app1 + content[insert_at:]
@@ -1,11 +1,9 @@
 from fastapi import APIRouter, HTTPException, UploadFile, File, Depends
-from fastapi.responses import StreamingResponse
 from PIL import Image, ImageDraw, ImageFont
-from mongo.database_handler import db
-from bson.objectid import ObjectId
 from auth.dependencies import get_current_user
 from models import UserInDB
-from bson.binary import Binary
+from processing.operations import operation, pixel_size
+from processing.pipeline import process_image
 from io import BytesIO
 
 router = APIRouter()
@@ -21,192 +19,170 @@ formats = {
     "webp": "WEBP"
 }
 
-# Change image format
-@router.get("/data/format/{ImageId}")
-async def change_format(ImageId: str, new_format: str, current_user: UserInDB = Depends(get_current_user)):
+def format_output(params: dict) -> tuple:
+    format = formats[params["new_format"]]
+    progressive = bool(params.get("progressive"))
+    # Pillow can't write interlaced PNGs, so only JPEG and GIF honour this.
+    # GIFs are interlaced unless told otherwise, so say so either way.
+    return format, {"JPEG": {"progressive": progressive}, "GIF": {"interlace": progressive}}.get(format, {})
 
-    """
-    Change the format of an image to a specified format.
-    - **ImageId**: The ID of the image to be converted.
-    - **new_format**: The desired format for the image (e.g., jpeg, png, webp).
-    - **Valid formats**: jpeg, jpg, png, bmp, gif, tif, tiff, webp.
-    """
-    
-    user = await db["users"].find_one({"_id": current_user.id})
+def compress_output(params: dict) -> tuple:
+    return "WEBP", {"optimize": True, "quality": params["quality_level"]}
 
-    if not user or "images" not in user or ImageId not in  user["images"]:
-        raise HTTPException(status_code=404, detail="Image not found")
-    
-    if new_format.casefold() not in formats:
+positions = ("TOP_LEFT", "TOP_RIGHT", "BOTTOM_LEFT", "BOTTOM_RIGHT", "CENTER", "WHOLE")
+
+def validate_format(params: dict):
+    if params["new_format"] not in formats:
         raise HTTPException(status_code=400, detail=f"Not valid format. List of valid formats: {formats.keys()}")
-    
 
-    image_data = user["images"][ImageId]
-    image_bytes = BytesIO(image_data["content"])
+def validate_compress(params: dict):
+    if params["quality_level"] > 100 or params["quality_level"] < 1:
+        raise HTTPException(status_code=400, detail="quality_level can't be greater than 100 or lower than 1")
 
-    try:
-        original_image = Image.open(image_bytes)
+def validate_watermark(params: dict):
+    if not params["watermark"] and not params["text"]:
+        raise HTTPException(status_code=400, detail="You must provide either a watermark image or text")
 
-        output_buffer = BytesIO()
-        original_image.save(output_buffer, format=formats[new_format])
-        output_buffer.seek(0)
+    if params["position"] not in positions:
+        raise HTTPException(status_code=400, detail="Invalid position specified")
 
-    except Exception as e:
-        raise HTTPException(400, detail=f"Image processing failed: {str(e)}")
+def webp_memory(mode: str) -> int:
+    # libwebp's working buffers per pixel, plus the RGB(A) copy Pillow
+    # converts other modes to first.
+    return 7 if mode in ("RGB", "RGBA") else 11
 
-    return StreamingResponse(
-        output_buffer,
-        media_type=f"image/{formats[new_format].casefold()}",
-        headers={
-            "Content-Disposition": f"inline; filename=new_format.{new_format}"
-        }
-    )    
+def format_memory(width: int, height: int, mode: str, params: dict) -> int:
+    # The image is encoded as decoded; only WebP's encoder needs much more.
+    encoder = webp_memory(mode) if formats.get(params["new_format"]) == "WEBP" else pixel_size(mode)
+    return width * height * (pixel_size(mode) + encoder)
 
+def compress_memory(width: int, height: int, mode: str, params: dict) -> int:
+    # The input and its resampled copy, then the copy and the WebP encoder.
+    return width * height * max(2 * pixel_size(mode), pixel_size(mode) + webp_memory(mode))
 
-# Compress image
-@router.get("/data/compress/{ImageId}")
-async def compress_image(ImageId: str, quality_level: int, current_user: UserInDB = Depends(get_current_user)):
-    
-    """
-    Compress an image to a specified quality level.
-    - **ImageId**: The ID of the image to be compressed.
-    - **quality_level**: The quality level for compression (1-100).
-    """
+def watermark_memory(width: int, height: int, mode: str, params: dict) -> int:
+    # The watermark is decoded as RGBA; its encoded size bounds it loosely.
+    return 2 * width * height * pixel_size(mode) + 4 * len(params.get("watermark") or b"")
 
-    user = await db["users"].find_one({"_id": current_user.id})
+@operation("data/format", output=format_output, memory=format_memory, validate=validate_format)
+def apply_format(original_image: Image.Image, new_format: str, progressive: bool = False) -> Image.Image:
+    return original_image
 
-    if not user or "images" not in user or ImageId not in  user["images"]:
-        raise HTTPException(status_code=404, detail="Image not found")
+@operation("data/compress", output=compress_output, memory=compress_memory, validate=validate_compress)
+def apply_compress(original_image: Image.Image, quality_level: int) -> Image.Image:
+    w, h = original_image.size
 
+    return original_image.resize((w, h), Image.LANCZOS)
 
-    if quality_level > 100 or quality_level < 1:
-        raise HTTPException(status_code=400, detail="quality_level can't be greater than 100 or lower than 1")
-    
+@operation("data/watermark", memory=watermark_memory, validate=validate_watermark)
+def apply_watermark(original_image: Image.Image, watermark: bytes = None, text: str = None, position: str = "BOTTOM_RIGHT") -> Image.Image:
+    w, h = original_image.size
 
-    image_data = user["images"][ImageId]
-    image_bytes = BytesIO(image_data["content"])
+    if watermark:
+        watermark_image = Image.open(BytesIO(watermark)).convert("RGBA")
 
-    try:
-        original_image = Image.open(image_bytes)
+        max_wm_w = w // 4
+        max_wm_h = h // 4
+        wm_w, wm_h = watermark_image.size
 
-        w, h = original_image.size
+        if wm_w > max_wm_w or wm_h > max_wm_h:
+            ratio = min(max_wm_w / wm_w, max_wm_h / wm_h)
+            new_size = (int(wm_w * ratio), int(wm_h * ratio))
+            watermark_image = watermark_image.resize(new_size, Image.LANCZOS)
+            wm_w, wm_h = watermark_image.size
 
-        original_image = original_image.resize((w, h), Image.LANCZOS)
+        pos_x, pos_y = get_position(position, w, h, wm_w, wm_h)
+        original_image.paste(watermark_image, (pos_x, pos_y), watermark_image)
 
-        output_buffer = BytesIO()
-        original_image.save(output_buffer, format="WEBP", optimize=True, quality=quality_level)
-        output_buffer.seek(0)
+    if text:
+        draw = ImageDraw.Draw(original_image)
 
-    except Exception as e:
-        raise HTTPException(400, detail=f"Image processing failed: {str(e)}")
 
-    return StreamingResponse(
-        output_buffer,
-        media_type=f"image/webp",
-        headers={
-            "Content-Disposition": f"inline; filename=compressed_{ImageId}.webp"
-        }
-    )    
+        font_size = min(w, h) // 30
+        try:
+            font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", font_size)
+        except:
+            font = ImageFont.load_default()
 
+        bbox = draw.textbbox((0, 0), text, font=font)
+        text_w = bbox[2] - bbox[0]
+        text_h = bbox[3] - bbox[1]
+
+        if text_w > w // 3:
+            ratio = (w // 3) / text_w
+            font_size = int(font_size * ratio)
+            try:
+                font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", font_size)
+            except:
+                font = ImageFont.load_default()
+            bbox = draw.textbbox((0, 0), text, font=font)
+            text_w = bbox[2] - bbox[0]
+            text_h = bbox[3] - bbox[1]
+
+        pos_x, pos_y = get_position(position, w, h, text_w, text_h)
+
+        outline_color = "black"
+        for dx, dy in [(-1,-1), (-1,1), (1,-1), (1,1)]:
+            draw.text((pos_x + dx, pos_y + dy), text, font=font, fill=outline_color)
+        draw.text((pos_x, pos_y), text, font=font, fill="white")
+
+    return original_image
+
+
+# Change image format
+@router.get("/data/format/{ImageId}")
+async def change_format(ImageId: str, new_format: str, progressive: bool = False, save: bool = False, current_user: UserInDB = Depends(get_current_user)):
 
-# Add watermark to image
-@router.post("/data/watermark/{ImageId}")
-async def add_watermark(ImageId: str, watermark: UploadFile = File(None), text: str = None, position: str = "BOTTOM_RIGHT", current_user: UserInDB = Depends(get_current_user)):    
     """
-    Add a watermark to an image by either uploading a watermark image or providing text.
-    - **ImageId**: The ID of the image to which the watermark will be added.
-    - **watermark**: An optional watermark image file.
-    - **text**: Optional text to be used as a watermark.
-    - **position**: The position of the watermark on the image. Default is "BOTTOM_RIGHT".
+    Change the format of an image to a specified format.
+    - **ImageId**: The ID of the image to be converted.
+    - **new_format**: The desired format for the image (e.g., jpeg, png, webp).
+    - **Valid formats**: jpeg, jpg, png, bmp, gif, tif, tiff, webp.
+    - **progressive**: Encode a progressive JPEG or an interlaced GIF, which
+      browsers can show in rough form before the download completes.
+    - **save**: Store the result as a new image instead of returning it.
     """
 
-    
-    user = await db["users"].find_one({"_id": current_user.id})
+    params = {"new_format": new_format.casefold(), "progressive": progressive}
+    return await process_image(ImageId, current_user.id, "data/format", params, "new_format", save)
 
-    if not user or "images" not in user or ImageId not in  user["images"]:
-        raise HTTPException(status_code=404, detail="Image not found")
 
+# Compress image
+@router.get("/data/compress/{ImageId}")
+async def compress_image(ImageId: str, quality_level: int, save: bool = False, current_user: UserInDB = Depends(get_current_user)):
 
-    if not watermark and not text:
-        raise HTTPException(status_code=400, detail="You must provide either a watermark image or text")
+    """
+    Compress an image to a specified quality level.
+    - **ImageId**: The ID of the image to be compressed.
+    - **quality_level**: The quality level for compression (1-100).
+    - **save**: Store the result as a new image instead of returning it.
+    """
 
-    image_data = user["images"][ImageId]
-    image_bytes = BytesIO(image_data["content"])
+    params = {"quality_level": quality_level}
+    return await process_image(ImageId, current_user.id, "data/compress", params, f"compressed_{ImageId}", save)
 
-    try:
-        original_image = Image.open(image_bytes)
-        w, h = original_image.size
 
-        if watermark:
-            watermark_bytes = await watermark.read()
-            watermark_image = Image.open(BytesIO(watermark_bytes)).convert("RGBA")
-            
-            max_wm_w = w // 4
-            max_wm_h = h // 4
-            wm_w, wm_h = watermark_image.size
-            
-            if wm_w > max_wm_w or wm_h > max_wm_h:
-                ratio = min(max_wm_w / wm_w, max_wm_h / wm_h)
-                new_size = (int(wm_w * ratio), int(wm_h * ratio))
-                watermark_image = watermark_image.resize(new_size, Image.LANCZOS)
-                wm_w, wm_h = watermark_image.size
-
-            pos_x, pos_y = await get_position(position, w, h, wm_w, wm_h)
-            original_image.paste(watermark_image, (pos_x, pos_y), watermark_image)
-
-        if text:
-            draw = ImageDraw.Draw(original_image)
-            
-            
-            font_size = min(w, h) // 30
-            try:
-                font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", font_size)
-            except:
-                font = ImageFont.load_default()
-            
-            bbox = draw.textbbox((0, 0), text, font=font)
-            text_w = bbox[2] - bbox[0]
-            text_h = bbox[3] - bbox[1]
-            
-            if text_w > w // 3:
-                ratio = (w // 3) / text_w
-                font_size = int(font_size * ratio)
-                try:
-                    font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", font_size)
-                except:
-                    font = ImageFont.load_default()
-                bbox = draw.textbbox((0, 0), text, font=font)
-                text_w = bbox[2] - bbox[0]
-                text_h = bbox[3] - bbox[1]
-            
-            pos_x, pos_y = await get_position(position, w, h, text_w, text_h)
-            
-            outline_color = "black"
-            for dx, dy in [(-1,-1), (-1,1), (1,-1), (1,1)]:
-                draw.text((pos_x + dx, pos_y + dy), text, font=font, fill=outline_color)
-            draw.text((pos_x, pos_y), text, font=font, fill="white")
-
-        output_buffer = BytesIO()
-        original_image.save(output_buffer, format="PNG")
-        output_buffer.seek(0)
-
-    except Exception as e:
-        raise HTTPException(400, detail=f"Image processing failed: {str(e)}")
-
-    return StreamingResponse(
-        output_buffer,
-        media_type="image/png",
-        headers={
-            "Content-Disposition": f"inline; filename=watermarked_{ImageId}.png"
-        }
-    )
-    
+# Add watermark to image
+@router.post("/data/watermark/{ImageId}")
+async def add_watermark(ImageId: str, watermark: UploadFile = File(None), text: str = None, position: str = "BOTTOM_RIGHT", save: bool = False, current_user: UserInDB = Depends(get_current_user)):
+    """
+    Add a watermark to an image by either uploading a watermark image or providing text.
+    - **ImageId**: The ID of the image to which the watermark will be added.
+    - **watermark**: An optional watermark image file.
+    - **text**: Optional text to be used as a watermark.
+    - **position**: The position of the watermark on the image. Default is "BOTTOM_RIGHT".
+    - **save**: Store the result as a new image instead of returning it.
+    """
 
-    
-    
+    params = {
+        "watermark": await watermark.read() if watermark else None,
+        "text": text,
+        "position": position
+    }
+    return await process_image(ImageId, current_user.id, "data/watermark", params, f"watermarked_{ImageId}", save)
 
 
-async def get_position(position: str, width: int, height: int, content_width: int, content_height: int) -> tuple:
+def get_position(position: str, width: int, height: int, content_width: int, content_height: int) -> tuple:
  
     padding = 10  # pixels de margem
     
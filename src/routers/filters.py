@@ -1,214 +1,232 @@
 from fastapi import APIRouter, HTTPException, Depends
-from fastapi.responses import StreamingResponse
-from mongo.database_handler import db
-from bson.objectid import ObjectId
-from bson.binary import Binary
 from PIL import Image, ImageOps, ImageFilter
-from io import BytesIO
 from models import UserInDB
 from auth.dependencies import get_current_user
+from processing.operations import operation, pixel_size
+from processing.pipeline import process_image
+from processing import convolution
 import numpy as np
 
 
 router = APIRouter()
 
-# Grayscale filter
-@router.get("/filter/grayscale/{ImageId}")
-async def grayscale(ImageId: str, current_user: UserInDB = Depends(get_current_user)):
-    
-    """
-    Convert an image to grayscale.
-    - **ImageId**: The ID of the image to be converted.
-    """
+@operation("filter/grayscale")
+def apply_grayscale(original_image: Image.Image) -> Image.Image:
+    return ImageOps.grayscale(original_image)
 
-    user = await db["users"].find_one({"_id": current_user.id})
+@operation("filter/negative")
+def apply_negative(original_image: Image.Image) -> Image.Image:
+    return ImageOps.invert(original_image)
 
-    if not user or "images" not in user or ImageId not in  user["images"]:
-        raise HTTPException(status_code=404, detail="Image not found")
+def validate_posterize(params: dict):
+    if params["bits"] > 8 or params["bits"] < 1:
+        raise HTTPException(status_code=400, detail="Posterize bits can't be greater than 8 or less than 1")
 
-    image_data = user["images"][ImageId]
-    image_bytes = BytesIO(image_data["content"])
+@operation("filter/posterize", validate=validate_posterize)
+def apply_posterize(original_image: Image.Image, bits: int) -> Image.Image:
+    return ImageOps.posterize(original_image, bits)
 
-    try:
-        original_image = Image.open(image_bytes)
+def sepia_memory(width: int, height: int, mode: str, params: dict) -> int:
+    # Decoded input, RGB copy, float32 image, products, stacked and clipped
+    # float32 results and the uint8 output: about 48 bytes per pixel.
+    return width * height * (pixel_size(mode) + 48)
 
-        modified_image = ImageOps.grayscale(original_image)
+@operation("filter/sepia", memory=sepia_memory)
+def apply_sepia(original_image: Image.Image) -> Image.Image:
+    image = original_image.convert("RGB")
 
-        output_buffer = BytesIO()
-        modified_image.save(output_buffer, format="PNG")
-        output_buffer.seek(0)
-    except Exception as e:
-        raise HTTPException(400, detail=f"Image processing failed: {str(e)}")
+    image = np.asarray(image).astype(np.float32)  / 255.0
 
-    return StreamingResponse(
-        output_buffer,
-        media_type="image/png",
-        headers={
-            "Content-Disposition": f"inline; filename=grayscaled_{ImageId}.png"
-        }
-    )    
 
+    R, G, B = image[...,0], image[...,1], image[...,2]
+    image_out = np.dstack((0.393 * R + 0.769 * G + 0.189 * B, \
+                           0.349 * R + 0.686 * G + 0.168 * B, \
+                           0.272 * R + 0.534 * G + 0.131 * B))
 
-# Negative filter
-@router.get("/filter/negative/{ImageId}")
-async def negative(ImageId: str, current_user: UserInDB = Depends(get_current_user)):
+    image_out = np.clip(image_out, 0, 1)
 
-    """
-    Convert an image to its negative.
-    - **ImageId**: The ID of the image to be converted.
-    """
+    image_result = (255*image_out).astype(np.uint8)
+    return Image.fromarray(image_result)
+
+@operation("filter/sharpen")
+def apply_sharpen(original_image: Image.Image) -> Image.Image:
+    return original_image.filter(ImageFilter.SHARPEN)
+
+
+def blur_memory(width: int, height: int, mode: str, params: dict) -> int:
+    # The input, the RGB(A) or grayscale copy palette and bilevel images are
+    # converted to, and Pillow's result and the intermediate of its
+    # horizontal pass.
+    filtered = convolution.filterable_mode(mode)
+    converted = pixel_size(filtered) if filtered != mode else 0
+    return width * height * (pixel_size(mode) + converted + 2 * pixel_size(filtered))
+
+def convolution_memory(width: int, height: int, mode: str, params: dict) -> int:
+    # The input and its converted copy, a float32 copy of every band, and up
+    # to five float32 arrays per colour channel on the two-pass path: the
+    # sum, the inner pass, the padded outer input, the outer pass and a
+    # product temporary. Alpha is carried through, not convolved.
+    filtered = convolution.filterable_mode(mode)
+    if filtered not in ("L", "LA", "RGB", "RGBA"):
+        filtered = "RGB"
+    converted = pixel_size(filtered) if filtered != mode else 0
+    bands = Image.getmodebands(filtered)
+    channels = bands - 1 if filtered in ("LA", "RGBA") else bands
+    return width * height * (pixel_size(mode) + converted + 4 * bands + 20 * channels)
 
-    user = await db["users"].find_one({"_id": current_user.id})
+def validate_radius(radius: float):
+    if radius < 0 or radius > convolution.MAX_RADIUS:
+        raise HTTPException(status_code=400, detail=f"radius must be between 0 and {convolution.MAX_RADIUS}")
 
-    if not user or "images" not in user or ImageId not in  user["images"]:
-        raise HTTPException(status_code=404, detail="Image not found")
+def validate_blur(params: dict):
+    validate_radius(params["radius"])
 
-    image_data = user["images"][ImageId]
-    image_bytes = BytesIO(image_data["content"])
+    if params["method"] not in ("gaussian", "box"):
+        raise HTTPException(status_code=400, detail="Not valid method. Valid methods: gaussian, box")
 
+def validate_unsharp(params: dict):
+    validate_radius(params["radius"])
+
+    if params["percent"] < 0 or params["threshold"] < 0 or params["threshold"] > 255:
+        raise HTTPException(status_code=400, detail="percent must be positive and threshold between 0 and 255")
+
+def validate_convolve(params: dict):
     try:
-        original_image = Image.open(image_bytes)
+        convolution.parse_kernel(params["kernel"])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Not valid kernel: {str(e)}")
 
-        modified_image = ImageOps.invert(original_image)
+    if params["scale"] == 0:
+        raise HTTPException(status_code=400, detail="scale can't be 0")
 
-        output_buffer = BytesIO()
-        modified_image.save(output_buffer, format="PNG")
-        output_buffer.seek(0)
-    except Exception as e:
-        raise HTTPException(400, detail=f"Image processing failed: {str(e)}")
+@operation("filter/blur", memory=blur_memory, validate=validate_blur)
+def apply_blur(original_image: Image.Image, radius: float, method: str = "gaussian") -> Image.Image:
+    if method == "box":
+        return convolution.box_blur(original_image, radius)
+    return convolution.gaussian_blur(original_image, radius)
 
-    return StreamingResponse(
-        output_buffer,
-        media_type="image/png",
-        headers={
-            "Content-Disposition": f"inline; filename=negative_{ImageId}.png"
-        }
-    )    
+@operation("filter/unsharp", memory=blur_memory, validate=validate_unsharp)
+def apply_unsharp(original_image: Image.Image, radius: float = 2, percent: int = 150, threshold: int = 3) -> Image.Image:
+    return convolution.unsharp_mask(original_image, radius, percent, threshold)
 
+@operation("filter/convolve", memory=convolution_memory, validate=validate_convolve)
+def apply_convolve(original_image: Image.Image, kernel: str, scale: float = None, offset: float = 0) -> Image.Image:
+    return convolution.convolve(original_image, convolution.parse_kernel(kernel), scale, offset)
+
+
+# Grayscale filter
+@router.get("/filter/grayscale/{ImageId}")
+async def grayscale(ImageId: str, save: bool = False, current_user: UserInDB = Depends(get_current_user)):
 
-# Posterize filter
-@router.get("/filter/posterize/{ImageId}")
-async def posterize(ImageId: str, bits: int, current_user: UserInDB = Depends(get_current_user)):
-    
     """
-    Posterize an image to a specified number of bits.
-    - **ImageId**: The ID of the image to be posterized.
-    - **bits**: The number of bits to posterize the image (1-8).
+    Convert an image to grayscale.
+    - **ImageId**: The ID of the image to be converted.
+    - **save**: Store the result as a new image instead of returning it.
     """
 
-    if bits > 8 or bits < 1:
-        raise HTTPException(500, detail="Posterize bits can't be greater than 8 or less than 1")
+    return await process_image(ImageId, current_user.id, "filter/grayscale", {}, f"grayscaled_{ImageId}", save)
 
-    user = await db["users"].find_one({"_id": current_user.id})
 
-    if not user or "images" not in user or ImageId not in  user["images"]:
-        raise HTTPException(status_code=404, detail="Image not found")
+# Negative filter
+@router.get("/filter/negative/{ImageId}")
+async def negative(ImageId: str, save: bool = False, current_user: UserInDB = Depends(get_current_user)):
 
-    image_data = user["images"][ImageId]
-    image_bytes = BytesIO(image_data["content"])
+    """
+    Convert an image to its negative.
+    - **ImageId**: The ID of the image to be converted.
+    - **save**: Store the result as a new image instead of returning it.
+    """
 
-    try:
-        original_image = Image.open(image_bytes)
+    return await process_image(ImageId, current_user.id, "filter/negative", {}, f"negative_{ImageId}", save)
 
-        modified_image = ImageOps.posterize(original_image, bits)
 
-        output_buffer = BytesIO()
-        modified_image.save(output_buffer, format="PNG")
-        output_buffer.seek(0)
-    except Exception as e:
-        raise HTTPException(400, detail=f"Image processing failed: {str(e)}")
+# Posterize filter
+@router.get("/filter/posterize/{ImageId}")
+async def posterize(ImageId: str, bits: int, save: bool = False, current_user: UserInDB = Depends(get_current_user)):
+
+    """
+    Posterize an image to a specified number of bits.
+    - **ImageId**: The ID of the image to be posterized.
+    - **bits**: The number of bits to posterize the image (1-8).
+    - **save**: Store the result as a new image instead of returning it.
+    """
 
-    return StreamingResponse(
-        output_buffer,
-        media_type="image/png",
-        headers={
-            "Content-Disposition": f"inline; filename=posterized_{ImageId}.png"
-        }
-    )    
+    return await process_image(ImageId, current_user.id, "filter/posterize", {"bits": bits}, f"posterized_{ImageId}", save)
 
 
 # Sepia filter
 @router.get("/filter/sepia/{ImageId}")
-async def sepia(ImageId: str, current_user: UserInDB = Depends(get_current_user)):
+async def sepia(ImageId: str, save: bool = False, current_user: UserInDB = Depends(get_current_user)):
 
     """
     Apply a sepia filter to an image.
     - **ImageId**: The ID of the image to be processed.
+    - **save**: Store the result as a new image instead of returning it.
     """
 
-    user = await db["users"].find_one({"_id": current_user.id})
+    return await process_image(ImageId, current_user.id, "filter/sepia", {}, f"sepia_{ImageId}", save)
 
-    if not user or "images" not in user or ImageId not in  user["images"]:
-        raise HTTPException(status_code=404, detail="Image not found")
 
-    image_data = user["images"][ImageId]
-    image_bytes = BytesIO(image_data["content"])
+# Sharpen image
+@router.get("/filter/sharpen/{ImageId}")
+async def sharpen(ImageId: str, save: bool = False, current_user: UserInDB = Depends(get_current_user)):
 
-    try:
-        image = Image.open(image_bytes).convert("RGB")
+    """
+    Apply a sharpen filter to an image.
+    - **ImageId**: The ID of the image to be processed.
+    - **save**: Store the result as a new image instead of returning it.
+    """
 
-        image = np.asarray(image).astype(np.float32)  / 255.0
-        
+    return await process_image(ImageId, current_user.id, "filter/sharpen", {}, f"sharpened_{ImageId}", save)
 
-        R, G, B = image[...,0], image[...,1], image[...,2]
-        image_out = np.dstack((0.393 * R + 0.769 * G + 0.189 * B, \
-                               0.349 * R + 0.686 * G + 0.168 * B, \
-                               0.272 * R + 0.534 * G + 0.131 * B))
-        
-        image_out = np.clip(image_out, 0, 1)
 
-        image_result = (255*image_out).astype(np.uint8)
-        image_result = Image.fromarray(image_result)
+# Blur image
+@router.get("/filter/blur/{ImageId}")
+async def blur(ImageId: str, radius: float, method: str = "gaussian", save: bool = False, current_user: UserInDB = Depends(get_current_user)):
 
-        output_buffer = BytesIO()
-        image_result.save(output_buffer, format="PNG")
-        output_buffer.seek(0)
+    """
+    Blur an image. Both methods cost the same at any radius.
+    - **ImageId**: The ID of the image to be processed.
+    - **radius**: The blur radius in pixels (0-250).
+    - **method**: gaussian (default) or box.
+    - **save**: Store the result as a new image instead of returning it.
+    """
 
-    except Exception as e:
-        raise HTTPException(400, detail=f"Image processing failed: {str(e)}")
+    params = {"radius": radius, "method": method}
+    return await process_image(ImageId, current_user.id, "filter/blur", params, f"blurred_{ImageId}", save)
 
-    return StreamingResponse(
-        output_buffer,
-        media_type="image/png",
-        headers={
-            "Content-Disposition": f"inline; filename=sepia_{ImageId}.png"
-        }
-    )    
 
+# Unsharp mask
+@router.get("/filter/unsharp/{ImageId}")
+async def unsharp(ImageId: str, radius: float = 2, percent: int = 150, threshold: int = 3, save: bool = False, current_user: UserInDB = Depends(get_current_user)):
 
-# Sharpen image
-@router.get("/filter/sharpen/{ImageId}")
-async def sharpen(ImageId: str, current_user: UserInDB = Depends(get_current_user)):
-    
     """
-    Apply a sharpen filter to an image.
+    Sharpen an image with an unsharp mask.
     - **ImageId**: The ID of the image to be processed.
+    - **radius**: Blur radius of the mask in pixels (0-250).
+    - **percent**: Strength of the sharpening, in percent.
+    - **threshold**: Smallest brightness change (0-255) that gets sharpened.
+    - **save**: Store the result as a new image instead of returning it.
     """
 
-    user = await db["users"].find_one({"_id": current_user.id})
-
-    if not user or "images" not in user or ImageId not in  user["images"]:
-        raise HTTPException(status_code=404, detail="Image not found")
-
-    image_data = user["images"][ImageId]
-    image_bytes = BytesIO(image_data["content"])
-
-    try:
-        original_image = Image.open(image_bytes)
+    params = {"radius": radius, "percent": percent, "threshold": threshold}
+    return await process_image(ImageId, current_user.id, "filter/unsharp", params, f"unsharp_{ImageId}", save)
 
-        modified_image = original_image.filter(ImageFilter.SHARPEN)
 
-        output_buffer = BytesIO()
-        modified_image.save(output_buffer, format="PNG")
-        output_buffer.seek(0)
+# Custom convolution kernel
+@router.get("/filter/convolve/{ImageId}")
+async def convolve(ImageId: str, kernel: str, scale: float = None, offset: float = 0, save: bool = False, current_user: UserInDB = Depends(get_current_user)):
 
-    except Exception as e:
-        raise HTTPException(400, detail=f"Image processing failed: {str(e)}")
+    """
+    Convolve an image with a custom kernel. Separable kernels, such as
+    Gaussians or Sobel operators, automatically run as two one-dimensional passes.
+    - **ImageId**: The ID of the image to be processed.
+    - **kernel**: Rows separated by ";" and values by ",", e.g. 1,2,1;2,4,2;1,2,1.
+      Both sides must be odd and at most 15.
+    - **scale**: Divisor for the weighted sum. Defaults to the kernel sum, or 1 if that is 0.
+    - **offset**: Value added after scaling.
+    - **save**: Store the result as a new image instead of returning it.
+    """
 
-    return StreamingResponse(
-        output_buffer,
-        media_type="image/png",
-        headers={
-            "Content-Disposition": f"inline; filename=sharpened_{ImageId}.png"
-        }
-    )    
+    params = {"kernel": kernel, "scale": scale, "offset": offset}
+    return await process_image(ImageId, current_user.id, "filter/convolve", params, f"convolved_{ImageId}", save)
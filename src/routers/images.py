@@ -1,10 +1,15 @@
-from fastapi import APIRouter, File, UploadFile, Form, HTTPException, Depends
+from fastapi import APIRouter, File, UploadFile, Form, HTTPException, Depends, Request
 from fastapi.responses import StreamingResponse
 from mongo.database_handler import db
 from bson.objectid import ObjectId
 from bson.binary import Binary
 from auth.dependencies import get_current_user
-from models import UserInDB
+from models import UserInDB, LinkReq
+from processing.lineage import load_content, evict_content, restore_children
+from processing.operations import operations, validate_params
+from processing.similarity import similarity_index, hash_image
+from processing.bulk import import_images, export_images, list_images, archive_formats
+from auth.jwt import create_capability_token, CAPABILITY_MAX_EXPIRE_SECONDS
 import io
 
 router = APIRouter()
@@ -22,7 +27,8 @@ async def upload_image(
             "filename": image.filename,
             "content": Binary(image_content),
             "description": description,
-            "content_type": image.content_type
+            "content_type": image.content_type,
+            "phash": await hash_image(image_content)
         }
         
         
@@ -37,12 +43,46 @@ async def upload_image(
         
         if result.modified_count == 0:
             raise HTTPException(status_code=400, detail="Failed to upload image")
+
+        similarity_index.add(current_user.id, image_data["id"], image_data["phash"])
             
         return {"message": "Image uploaded successfully", "image_id": image_data["id"]}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/images/bulk")
+async def bulk_upload_images(
+    images: list[UploadFile] = File(...),
+    description: str = Form(None),
+    current_user: UserInDB = Depends(get_current_user)
+):
+    """
+    Upload many images in one request.
+    - **images**: Image files, or zip/tar archives whose members are stored as images.
+      A manifest.json from an export restores filenames and descriptions.
+    - **description**: Description for files that don't get one from a manifest.
+    """
+    return await import_images(current_user, images, description)
+
+@router.get("/images/export")
+async def export_all_images(
+    format: str = "tar",
+    current_user: UserInDB = Depends(get_current_user)
+):
+    """
+    Download every image as one archive, with a manifest.json of their metadata.
+    - **format**: "tar" or "zip".
+    """
+    if format not in archive_formats:
+        raise HTTPException(status_code=400, detail="Unsupported archive format")
+
+    return StreamingResponse(
+        export_images(current_user.id, format),
+        media_type=archive_formats[format],
+        headers={"Content-Disposition": f"attachment; filename=images.{format}"}
+    )
+
 @router.get("/images/{image_id}")
 async def get_image(
     image_id: str,
@@ -54,8 +94,9 @@ async def get_image(
         raise HTTPException(status_code=404, detail="Image not found")
         
     image_data = user["images"][image_id]
+    content = await load_content(user, image_id)
     return StreamingResponse(
-        io.BytesIO(image_data["content"]),
+        io.BytesIO(content),
         media_type=image_data["content_type"]
     )
 
@@ -75,6 +116,14 @@ async def get_all_images(current_user: UserInDB = Depends(get_current_user)):
             "description": image_data["description"],
             "content_type": image_data["content_type"]
         }
+
+        if image_data.get("parent_id"):
+            images_list[image_id]["lineage"] = {
+                "parent_id": image_data["parent_id"],
+                "operation": image_data["operation"],
+                "params": {k: v for k, v in image_data["params"].items() if not isinstance(v, bytes)},
+                "evicted": image_data.get("content") is None
+            }
     
     return {"images": images_list}
 
@@ -83,6 +132,13 @@ async def delete_image(
     image_id: str,
     current_user: UserInDB = Depends(get_current_user)
 ):
+    user = await db["users"].find_one({"_id": current_user.id})
+
+    if not user or "images" not in user or image_id not in user["images"]:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    await restore_children(user, image_id)
+
     result = await db["users"].update_one(
         {"_id": current_user.id},
         {"$unset": {f"images.{image_id}": ""}}
@@ -90,9 +146,93 @@ async def delete_image(
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Image not found")
+
+    similarity_index.discard(current_user.id, image_id)
         
     return {"message": "Image deleted successfully"}
 
+@router.get("/images/{image_id}/similar")
+async def get_similar_images(
+    image_id: str,
+    max_distance: int = 10,
+    current_user: UserInDB = Depends(get_current_user)
+):
+    """
+    Find near-duplicates of an image: recompressed, resized or lightly edited copies.
+    - **max_distance**: Largest Hamming distance between 64-bit perceptual hashes (0-64).
+      0-5 finds near-identical copies; beyond about 12 unrelated images start to match.
+    """
+    if max_distance < 0 or max_distance > 64:
+        raise HTTPException(status_code=400, detail="max_distance must be between 0 and 64")
+
+    images = {image["id"]: image for image in await list_images(current_user.id)}
+
+    if image_id not in images:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    image_hash = images[image_id].get("phash")
+    if not image_hash:
+        raise HTTPException(status_code=409, detail="Image has no perceptual hash yet")
+
+    similarity_index.ensure(current_user.id, images, image_id)
+
+    similar = []
+    for distance, similar_id in similarity_index.search(current_user.id, image_hash, max_distance):
+        if similar_id == image_id:
+            continue
+        similar.append({
+            "id": similar_id,
+            "filename": images[similar_id].get("filename"),
+            "distance": distance
+        })
+
+    return {"images": similar}
+
+@router.post("/images/{image_id}/links")
+async def create_image_link(
+    image_id: str,
+    link_req: LinkReq,
+    request: Request,
+    current_user: UserInDB = Depends(get_current_user)
+):
+    """
+    Mint a signed, expiring URL for an image, or for one operation on it
+    (e.g. operation "transform/resize" with params {"width": 300, "height": 200}).
+    The URL needs no Authorization header and its responses are publicly cacheable.
+    """
+    user = await db["users"].find_one({"_id": current_user.id})
+
+    if not user or "images" not in user or image_id not in user["images"]:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    if link_req.expires_in < 1 or link_req.expires_in > CAPABILITY_MAX_EXPIRE_SECONDS:
+        raise HTTPException(status_code=400, detail=f"expires_in must be between 1 and {CAPABILITY_MAX_EXPIRE_SECONDS} seconds")
+
+    if link_req.operation is not None:
+        if link_req.operation not in operations:
+            raise HTTPException(status_code=400, detail=f"Not valid operation. List of valid operations: {operations.keys()}")
+
+        validate_params(link_req.operation, link_req.params)
+
+    token, expires = await create_capability_token(
+        current_user.id, image_id, link_req.operation, link_req.params, link_req.expires_in
+    )
+
+    return {"url": str(request.url_for("public_image", token=token)), "expires": expires}
+
+@router.delete("/images/{image_id}/content")
+async def evict_image_content(
+    image_id: str,
+    current_user: UserInDB = Depends(get_current_user)
+):
+    """
+    Drop the stored bytes of a derived image. Its lineage is kept and the
+    content is regenerated from the parent the next time it is requested.
+    """
+    await evict_content(current_user.id, image_id)
+
+    return {"message": "Image content evicted successfully"}
+
 @router.delete("/images")
 async def delete_all_images(current_user: UserInDB = Depends(get_current_user)):
     result = await db["users"].update_one(
@@ -102,6 +242,8 @@ async def delete_all_images(current_user: UserInDB = Depends(get_current_user)):
     
     if result.modified_count == 0:
         raise HTTPException(status_code=400, detail="Failed to delete images")
+
+    similarity_index.drop(current_user.id)
         
     return {"message": "All images deleted successfully"}
 
@@ -0,0 +1,41 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from mongo.database_handler import db
+from auth.jwt import decode_capability_token
+from processing.lineage import load_content
+from processing.pipeline import process_image
+import io
+import time
+
+router = APIRouter()
+
+@router.get("/public/{token}", name="public_image")
+async def public_image(token: str):
+    """
+    Deliver an image through a signed link from POST /images/{image_id}/links.
+    The signature is the only authorization, so responses can be shared by
+    caching proxies until the link expires.
+    """
+
+    claims = await decode_capability_token(token)
+    if claims is None:
+        raise HTTPException(status_code=403, detail="Invalid or expired link")
+
+    max_age = max(claims["exp"] - int(time.time()), 0)
+    headers = {"Cache-Control": f"public, max-age={max_age}, immutable"}
+
+    if claims["op"] is not None:
+        filename = f"{claims['op'].replace('/', '_')}_{claims['img']}"
+        return await process_image(claims["img"], claims["uid"], claims["op"], claims["params"], filename, headers=headers)
+
+    user = await db["users"].find_one({"_id": claims["uid"]})
+
+    if not user or "images" not in user or claims["img"] not in user["images"]:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    content = await load_content(user, claims["img"])
+    return StreamingResponse(
+        io.BytesIO(content),
+        media_type=user["images"][claims["img"]]["content_type"],
+        headers=headers
+    )
@@ -1,209 +1,202 @@
 from fastapi import APIRouter, HTTPException, Depends
-from fastapi.responses import StreamingResponse
-from mongo.database_handler import db
-from bson.objectid import ObjectId
-from bson.binary import Binary
-from PIL import Image
+from PIL import Image, ImageColor
 from auth.dependencies import get_current_user
 from models import UserInDB
-from io import BytesIO
+from processing.operations import operation, pixel_size
+from processing.pipeline import process_image
+from processing import transforms, resample as resampling
+import math
 
 
 router = APIRouter()
 
-# Mirror (Left-Right)
-@router.get("/transform/mirror/{ImageId}")
-async def mirror_image(ImageId: str, current_user: UserInDB = Depends(get_current_user)):
-    
-    """
-    Mirror an image horizontally.
-    - **ImageId**: The ID of the image to be mirrored.
-    """
+def orientation_fast_path(method):
+    """Build a fast path that reorients JPEGs through their EXIF tag when asked to."""
+
+    def fast_path(content: bytes, orientation_only: bool = False, **params):
+        if not orientation_only:
+            return None
+        transpose = method(**params)
+        if transpose is None:
+            return None
+        output = transforms.reorient_jpeg(content, transpose)
+        return (output, "JPEG") if output is not None else None
+
+    return fast_path
+
+def rotate_transpose(degrees: int, **params):
+    return transforms.right_angles.get(degrees % 360)
+
+def rotate_memory(width: int, height: int, mode: str, params: dict) -> int:
+    degrees = params["degrees"] % 360
+    area = width * height
+    if degrees == 0 or degrees in transforms.right_angles:
+        return 2 * area * pixel_size(mode)
+
+    output = area
+    if params.get("expand"):
+        angle = math.radians(degrees)
+        cos, sin = abs(math.cos(angle)), abs(math.sin(angle))
+        output = math.ceil(width * cos + height * sin) * math.ceil(width * sin + height * cos)
+
+    if mode in ("LA", "RGBA"):
+        # Pillow rotates these premultiplied: a converted copy of the input
+        # goes in and the rotated result is converted back.
+        return (area + max(area + output, 2 * output)) * pixel_size(mode)
+    return (area + output) * pixel_size(mode)
+
+def resize_draft(size: tuple, params: dict) -> tuple:
+    return resampling.scaled_size(size, params["width"], params["height"], params.get("mode", "stretch"))
+
+def resize_memory(width: int, height: int, mode: str, params: dict) -> int:
+    # The decode at its draft size, the copy `reduce` shrinks it to, the
+    # horizontal pass Pillow resamples through, and the result. LA and RGBA
+    # are resized premultiplied, which copies the input and the result once
+    # more; fill pastes onto a new canvas.
+    target_w, target_h = resize_draft((width, height), params)
+    factor_x = int(width / target_w / resampling.REDUCING_GAP) or 1
+    factor_y = int(height / target_h / resampling.REDUCING_GAP) or 1
+    reduced = (width // factor_x) * (height // factor_y) if factor_x * factor_y > 1 else 0
+    if params.get("mode") == "cover":
+        target_w, target_h = params["width"], params["height"]
+    output = target_w * target_h
+
+    total = width * height + reduced + target_w * (height // factor_y) + output
+    if mode in ("LA", "RGBA"):
+        total += width * height + output
+    if params.get("mode") == "fill":
+        total += params["width"] * params["height"]
+    return total * pixel_size(mode)
+
+def crop_memory(width: int, height: int, mode: str, params: dict) -> int:
+    box = max(params["right"] - params["left"], 0) * max(params["bottom"] - params["top"], 0)
+    return (width * height + box) * pixel_size(mode)
+
+def validate_fill(fill: str):
+    if fill is None:
+        return
+    try:
+        ImageColor.getrgb(fill)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Not valid fill color: {fill}")
 
-    user = await db["users"].find_one({"_id": current_user.id})
+def validate_rotate(params: dict):
+    validate_fill(params["fill"])
 
-    if not user or "images" not in user or ImageId not in  user["images"]:
-        raise HTTPException(status_code=404, detail="Image not found")
+def validate_resize(params: dict):
+    if params["width"] < 1 or params["height"] < 1:
+        raise HTTPException(status_code=400, detail="width and height must be at least 1")
 
-    image_data = user["images"][ImageId]
-    image_bytes = BytesIO(image_data["content"])
+    if params["mode"] not in resampling.resize_modes:
+        raise HTTPException(status_code=400, detail=f"Not valid mode. List of valid modes: {resampling.resize_modes}")
 
-    try:
-        original_image = Image.open(image_bytes)
+    if params["resample"] not in resampling.resampling_filters:
+        raise HTTPException(status_code=400, detail=f"Not valid resample filter. List of valid filters: {resampling.resampling_filters.keys()}")
 
-        modified_image = original_image.transpose(method=Image.Transpose.FLIP_LEFT_RIGHT)
+    validate_fill(params["fill"])
 
-        output_buffer = BytesIO()
-        modified_image.save(output_buffer, format="PNG")
-        output_buffer.seek(0)
+@operation("transform/mirror", fast_path=orientation_fast_path(lambda: Image.Transpose.FLIP_LEFT_RIGHT))
+def apply_mirror(original_image: Image.Image, orientation_only: bool = False) -> Image.Image:
+    return original_image.transpose(method=Image.Transpose.FLIP_LEFT_RIGHT)
 
-    except Exception as e:
-        raise HTTPException(400, detail=f"Image processing failed: {str(e)}")
+@operation("transform/flip", fast_path=orientation_fast_path(lambda: Image.Transpose.FLIP_TOP_BOTTOM))
+def apply_flip(original_image: Image.Image, orientation_only: bool = False) -> Image.Image:
+    return original_image.transpose(method=Image.Transpose.FLIP_TOP_BOTTOM)
 
-    return StreamingResponse(
-        output_buffer,
-        media_type=f"image/png",
-        headers={
-            "Content-Disposition": f"inline; filename=mirror_{ImageId}.png"
-        }
-    )    
+@operation("transform/rotate", fast_path=orientation_fast_path(rotate_transpose), memory=rotate_memory, validate=validate_rotate)
+def apply_rotate(original_image: Image.Image, degrees: int, expand: bool = False, fill: str = None, orientation_only: bool = False) -> Image.Image:
+    return transforms.rotate(original_image, degrees, expand, fill)
 
-# Flip (Up-Down)
-@router.get("/transform/flip/{ImageId}")
-async def flip_image(ImageId: str, current_user: UserInDB = Depends(get_current_user)):
+@operation("transform/resize", memory=resize_memory, draft=resize_draft, validate=validate_resize)
+def apply_resize(original_image: Image.Image, width: int, height: int, mode: str = "stretch", resample: str = "bicubic", fill: str = None) -> Image.Image:
+    return resampling.downscale(original_image, width, height, mode, resample, fill)
 
-    """
-    Flip an image vertically.
-    - **ImageId**: The ID of the image to be flipped.
-    """
-
-    user = await db["users"].find_one({"_id": current_user.id})
+@operation("transform/crop", memory=crop_memory)
+def apply_crop(original_image: Image.Image, left: int, top: int, right: int, bottom: int) -> Image.Image:
+    return transforms.crop(original_image, left, top, right, bottom)
 
-    if not user or "images" not in user or ImageId not in  user["images"]:
-        raise HTTPException(status_code=404, detail="Image not found")
 
-    image_data = user["images"][ImageId]
-    image_bytes = BytesIO(image_data["content"])
+# Mirror (Left-Right)
+@router.get("/transform/mirror/{ImageId}")
+async def mirror_image(ImageId: str, orientation_only: bool = False, save: bool = False, current_user: UserInDB = Depends(get_current_user)):
 
-    try:
-        original_image = Image.open(image_bytes)
+    """
+    Mirror an image horizontally.
+    - **ImageId**: The ID of the image to be mirrored.
+    - **orientation_only**: For JPEGs, rewrite the EXIF Orientation tag instead of the pixels.
+    - **save**: Store the result as a new image instead of returning it.
+    """
 
-        modified_image = original_image.transpose(method=Image.Transpose.FLIP_TOP_BOTTOM)
+    return await process_image(ImageId, current_user.id, "transform/mirror", {"orientation_only": orientation_only}, f"mirror_{ImageId}", save)
 
-        output_buffer = BytesIO()
-        modified_image.save(output_buffer, format="PNG")
-        output_buffer.seek(0)
+# Flip (Up-Down)
+@router.get("/transform/flip/{ImageId}")
+async def flip_image(ImageId: str, orientation_only: bool = False, save: bool = False, current_user: UserInDB = Depends(get_current_user)):
 
-    except Exception as e:
-        raise HTTPException(400, detail=f"Image processing failed: {str(e)}")
+    """
+    Flip an image vertically.
+    - **ImageId**: The ID of the image to be flipped.
+    - **orientation_only**: For JPEGs, rewrite the EXIF Orientation tag instead of the pixels.
+    - **save**: Store the result as a new image instead of returning it.
+    """
 
-    return StreamingResponse(
-        output_buffer,
-        media_type="image/png",
-        headers={
-            "Content-Disposition": f"inline; filename=flipped_{ImageId}.png"
-        }
-    )    
+    return await process_image(ImageId, current_user.id, "transform/flip", {"orientation_only": orientation_only}, f"flipped_{ImageId}", save)
 
 
 # Rotate image
 @router.get("/transform/rotate/{ImageId}")
-async def rotate_image(ImageId: str, degrees: int, current_user: UserInDB = Depends(get_current_user)):
-    
+async def rotate_image(ImageId: str, degrees: int, expand: bool = False, fill: str = None, orientation_only: bool = False, save: bool = False, current_user: UserInDB = Depends(get_current_user)):
+
     """
     Rotate an image by a specified number of degrees.
     - **ImageId**: The ID of the image to be rotated.
-    - **degrees**: The number of degrees to rotate the image.
+    - **degrees**: The number of degrees to rotate the image counter-clockwise.
+      Multiples of 90 are exact and keep every pixel.
+    - **expand**: For other angles, grow the canvas to fit the whole rotated image.
+    - **fill**: Color for the corners uncovered by the rotation (e.g. white, #ff0000).
+    - **orientation_only**: For JPEGs rotated by a multiple of 90, rewrite the
+      EXIF Orientation tag instead of the pixels.
+    - **save**: Store the result as a new image instead of returning it.
     """
 
-    user = await db["users"].find_one({"_id": current_user.id})
-
-    if not user or "images" not in user or ImageId not in  user["images"]:
-        raise HTTPException(status_code=404, detail="Image not found")
-
-    image_data = user["images"][ImageId]
-    image_bytes = BytesIO(image_data["content"])
-
-    try:
-        original_image = Image.open(image_bytes)
-
-        modified_image = original_image.rotate(degrees)
-
-        output_buffer = BytesIO()
-        modified_image.save(output_buffer, format="PNG")
-        output_buffer.seek(0)
-
-    except Exception as e:
-        raise HTTPException(400, detail=f"Image processing failed: {str(e)}")
-
-    return StreamingResponse(
-        output_buffer,
-        media_type="image/png",
-        headers={
-            "Content-Disposition": f"inline; filename=rotated_{degrees}_{ImageId}.png"
-        }
-    )    
+    params = {"degrees": degrees, "expand": expand, "fill": fill, "orientation_only": orientation_only}
+    return await process_image(ImageId, current_user.id, "transform/rotate", params, f"rotated_{degrees}_{ImageId}", save)
 
 
 # Resize image
 @router.get("/transform/resize/{ImageId}")
-async def resize_image(ImageId: str, width: int, height: int, current_user: UserInDB = Depends(get_current_user)):
-    
+async def resize_image(ImageId: str, width: int, height: int, mode: str = "stretch", resample: str = "bicubic", fill: str = None, save: bool = False, current_user: UserInDB = Depends(get_current_user)):
+
     """
     Resize an image to specified dimensions.
     - **ImageId**: The ID of the image to be resized.
     - **width**: The new width of the image.
     - **height**: The new height of the image.
+    - **mode**: How to treat the aspect ratio. stretch (default) resizes to exactly
+      width x height, fit stays inside the box, fill fits and pads to the box and
+      cover fills the box and trims the overflow.
+    - **resample**: Resampling filter: nearest, box, bilinear, hamming, bicubic (default) or lanczos.
+    - **fill**: Padding color for the fill mode (e.g. white, #ff0000).
+    - **save**: Store the result as a new image instead of returning it.
     """
 
-    user = await db["users"].find_one({"_id": current_user.id})
-
-    if not user or "images" not in user or ImageId not in  user["images"]:
-        raise HTTPException(status_code=404, detail="Image not found")
-
-    image_data = user["images"][ImageId]
-    image_bytes = BytesIO(image_data["content"])
-
-    try:
-        original_image = Image.open(image_bytes)
-
-        modified_image = original_image.resize((width, height))
-
-        output_buffer = BytesIO()
-        modified_image.save(output_buffer, format="PNG")
-        output_buffer.seek(0)
-
-    except Exception as e:
-        raise HTTPException(400, detail=f"Image processing failed: {str(e)}")
-
-    return StreamingResponse(
-        output_buffer,
-        media_type="image/png",
-        headers={
-            "Content-Disposition": f"inline; filename=resized_{width}x{height}_{ImageId}.png"
-        }
-    )    
+    params = {"width": width, "height": height, "mode": mode, "resample": resample, "fill": fill}
+    return await process_image(ImageId, current_user.id, "transform/resize", params, f"resized_{width}x{height}_{ImageId}", save)
 
 
 # Crop image
 @router.get("/transform/crop/{ImageId}")
-async def crop_image(ImageId: str, left: int, top: int, right: int, bottom: int, current_user: UserInDB = Depends(get_current_user)):
-    
+async def crop_image(ImageId: str, left: int, top: int, right: int, bottom: int, save: bool = False, current_user: UserInDB = Depends(get_current_user)):
+
     """
-    Crop an image to specified dimensions.
+    Crop an image to a pixel box inside it, without resampling.
     - **ImageId**: The ID of the image to be cropped.
     - **left**: The left coordinate of the crop rectangle.
     - **top**: The top coordinate of the crop rectangle.
     - **right**: The right coordinate of the crop rectangle.
     - **bottom**: The bottom coordinate of the crop rectangle.
+    - **save**: Store the result as a new image instead of returning it.
     """
-    
-    user = await db["users"].find_one({"_id": current_user.id})
 
-    if not user or "images" not in user or ImageId not in  user["images"]:
-        raise HTTPException(status_code=404, detail="Image not found")
-
-    image_data = user["images"][ImageId]
-    image_bytes = BytesIO(image_data["content"])
-
-    try:
-        original_image = Image.open(image_bytes)
-        width, height = original_image.size
-
-        modified_image = original_image.crop((left / width, top / height, right, bottom)).resize((width, height))
-        
-
-        output_buffer = BytesIO()
-        modified_image.save(output_buffer, format="PNG")
-        output_buffer.seek(0)
-
-    except Exception as e:
-        raise HTTPException(400, detail=f"Image processing failed: {str(e)}")
-
-    return StreamingResponse(
-        output_buffer,
-        media_type="image/png",
-        headers={
-            "Content-Disposition": f"inline; filename=cropped_{left}x{top}x{right}x{bottom}_{ImageId}.png"
-        }
-    )    
+    params = {"left": left, "top": top, "right": right, "bottom": bottom}
+    return await process_image(ImageId, current_user.id, "transform/crop", params, f"cropped_{left}x{top}x{right}x{bottom}_{ImageId}", save)